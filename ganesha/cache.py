@@ -0,0 +1,327 @@
+"""Caches of parsed map situations: on disk (MapCache) and in memory
+(SituationCache).
+
+Each situation is stored in one sidecar file: a JSON header describing the
+source files it was built from, followed by the decoded 4bpp texture and
+every resolved resource chunk. Reopening a situation memory-maps the
+sidecar and hands out views into it, so nothing is read or decoded again.
+
+The viewer fills the cache from a background thread after reading a
+situation from its source files. Fill it for a whole map directory ahead
+of time with:
+
+    python -m ganesha.cache MAP_DIR [--cache-dir DIR]
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from struct import pack, unpack
+
+import numpy as np
+
+from ganesha import fftmap
+from ganesha.resource import resource_pool
+
+MAGIC = b"GNSCACHE"
+VERSION = 1
+ALIGN = 16
+TEXTURE_SHAPE = (1024, 256)
+SITUATION_BUDGET = 64 * 1024 * 1024
+
+
+def default_cache_dir():
+    cache_dir = os.environ.get("GANESHA_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    return os.path.join(os.path.expanduser("~"), ".cache", "ganesha")
+
+
+def file_hash(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# SHA-1 of every file hashed so far, keyed by (path, size, mtime).
+hashes = {}
+hashes_lock = threading.Lock()
+
+
+def cached_file_hash(file_path, size, mtime):
+    key = (file_path, size, mtime)
+    with hashes_lock:
+        sha1 = hashes.get(key)
+    if sha1 is None:
+        sha1 = file_hash(file_path)
+        with hashes_lock:
+            hashes[key] = sha1
+    return sha1
+
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+class MapCache:
+    def __init__(self, cache_dir=None, background=True):
+        self.cache_dir = cache_dir or default_cache_dir()
+        # Write sidecars from a thread instead of the caller's.
+        self.background = background
+
+    def cache_path(self, texture_files, resource_files):
+        names = [os.path.abspath(path) for path in texture_files + resource_files]
+        name = hashlib.sha1("\0".join(names).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".cache")
+
+    def source_key(self, texture_files, resource_files, known=None):
+        """Describe the source files by size, mtime and content hash.
+
+        A file is only re-hashed when its size or mtime differs from the
+        entry in `known`, or from when it was last hashed in this process,
+        so validating an unchanged map costs a few stats.
+        """
+        known = {source["path"]: source for source in known or []}
+        sources = []
+        for role, files in (("tex", texture_files), ("res", resource_files)):
+            for file_path in files:
+                path = os.path.abspath(file_path)
+                stat = os.stat(path)
+                (size, mtime) = (stat.st_size, stat.st_mtime_ns)
+                source = {"role": role, "path": path, "size": size, "mtime": mtime}
+                old = known.get(path)
+                if old and old["size"] == size and old["mtime"] == mtime:
+                    source["sha1"] = old["sha1"]
+                else:
+                    source["sha1"] = cached_file_hash(path, size, mtime)
+                sources.append(source)
+        return sources
+
+    def load(self, fft_map):
+        """Fill `fft_map` from its sidecar. Returns False when there is no
+        usable entry and the map has to be read from the source files."""
+        if not self.cacheable(fft_map):
+            return False
+        cache_path = self.cache_path(fft_map.texture_files, fft_map.resource_files)
+        try:
+            with open(cache_path, "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            loaded = self.read_sidecar(fft_map, data)
+        except (struct.error, ValueError, KeyError, TypeError, IndexError):
+            # Truncated or corrupt; it is rewritten once the map is read.
+            loaded = False
+        if not loaded:
+            data.close()
+        return loaded
+
+    def read_sidecar(self, fft_map, data):
+        if data[0 : len(MAGIC)] != MAGIC:
+            return False
+        (version, header_size) = unpack("<II", data[8:16])
+        if version != VERSION:
+            return False
+        header = json.loads(bytes(data[16 : 16 + header_size]))
+        try:
+            sources = self.source_key(
+                fft_map.texture_files, fft_map.resource_files, header["sources"]
+            )
+        except OSError:
+            return False
+        fields = ("role", "path", "size", "sha1")
+        current = [[source[x] for x in fields] for source in sources]
+        cached = [[source[x] for x in fields] for source in header["sources"]]
+        if current != cached:
+            return False
+        (offset, size) = header["texture"]
+        blobs = [(offset, size)] + [(x, y) for (_, x, y) in header["chunks"]]
+        if size != TEXTURE_SHAPE[0] * TEXTURE_SHAPE[1]:
+            return False
+        if any(offset < 0 or offset + size > len(data) for (offset, size) in blobs):
+            return False
+
+        view = memoryview(data)
+        fft_map.texture_indices = np.frombuffer(
+            view, dtype=np.uint8, count=size, offset=offset
+        ).reshape(TEXTURE_SHAPE)
+        chunks = {}
+        for (i, offset, size) in header["chunks"]:
+            chunks[i] = view[offset : offset + size]
+        fft_map.resources.set_chunks(chunks)
+        if sources != header["sources"]:
+            # Touched but unchanged; record the new mtimes.
+            self.fill(fft_map, sources)
+        return True
+
+    def cacheable(self, fft_map):
+        # Disc images are already mapped whole; only plain files are cached.
+        files = fft_map.texture_files + fft_map.resource_files
+        return all(isinstance(file_path, str) for file_path in files)
+
+    def file_stats(self, fft_map):
+        stats = []
+        for file_path in fft_map.texture_files + fft_map.resource_files:
+            stat = os.stat(file_path)
+            stats.append((stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def fill(self, fft_map, sources=None):
+        """Store a situation that was just read, in the background unless
+        the cache was made with background=False."""
+        if not self.cacheable(fft_map):
+            return
+        if not self.background:
+            self.store(fft_map, sources)
+            return
+        # Map.set_situation rebinds the map's attributes rather than
+        # changing them, so a shallow copy keeps this situation's data.
+        snapshot = copy.copy(fft_map)
+        try:
+            stats = self.file_stats(snapshot)
+        except OSError:
+            return
+        thread = threading.Thread(
+            target=self.store, args=(snapshot, sources, stats), daemon=True
+        )
+        thread.start()
+
+    def store(self, fft_map, sources=None, stats=None):
+        """Write the sidecar for `fft_map`. If `stats` is given, the entry
+        is dropped when the source files changed since they were taken."""
+        if not self.cacheable(fft_map):
+            return False
+        if fft_map.texture.data is None and fft_map.texture_indices is None:
+            return False
+        try:
+            if sources is None:
+                sources = self.source_key(fft_map.texture_files, fft_map.resource_files)
+            blobs = [fft_map.get_texture().indices.tobytes()]
+            chunk_table = []
+            for i in range(49):
+                if fft_map.resources.has_chunk(i * 4):
+                    blobs.append(bytes(fft_map.resources.get_chunk(i * 4)))
+                    chunk_table.append(i)
+            header = self.header(sources, blobs, chunk_table)
+            cache_path = self.cache_path(fft_map.texture_files, fft_map.resource_files)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = "{}.{}.{}.tmp".format(
+                cache_path, os.getpid(), threading.get_ident()
+            )
+            with open(temp_path, "wb") as file:
+                file.write(MAGIC)
+                file.write(pack("<II", VERSION, len(header)))
+                file.write(header)
+                for blob in blobs:
+                    file.seek(aligned(file.tell()))
+                    file.write(blob)
+            if stats is not None and self.file_stats(fft_map) != stats:
+                # Saved while this was being written; the data may be stale.
+                os.remove(temp_path)
+                return False
+            os.replace(temp_path, cache_path)
+        except OSError as error:
+            print("Unable to write map cache:", error)
+            return False
+        return True
+
+    def header(self, sources, blobs, chunk_table):
+        # Offsets depend on the header's own length, so grow it until stable.
+        header = b""
+        while True:
+            offset = aligned(16 + len(header))
+            layout = []
+            for blob in blobs:
+                layout.append((offset, len(blob)))
+                offset = aligned(offset + len(blob))
+            new_header = json.dumps(
+                {
+                    "sources": sources,
+                    "texture": layout[0],
+                    "chunks": [
+                        (i, offset, size)
+                        for (i, (offset, size)) in zip(chunk_table, layout[1:])
+                    ],
+                }
+            ).encode("utf-8")
+            if len(new_header) == len(header):
+                return new_header
+            header = new_header
+
+
+class SituationCache:
+    """In-memory LRU of parsed situations, bounded by their size in bytes.
+
+    Entries are whatever Map.get_state returns, keyed by (GNS path,
+    situation index). The most recently used entry is always kept, even
+    if it alone is over the budget. Map.set_gns clears it, so it only ever
+    holds situations of the map whose base files are in the resource pool.
+    """
+
+    def __init__(self, budget=SITUATION_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, state, size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (state, size)
+        self.size += size
+        while self.size > self.budget and len(self.entries) > 1:
+            (_, (_, old_size)) = self.entries.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+def warm(map_dir, cache):
+    """Parse every situation of every GNS file in `map_dir` into `cache`."""
+    for file_name in sorted(os.listdir(map_dir)):
+        if file_name[-4:] not in [".gns", ".GNS"]:
+            continue
+        fft_map = fftmap.Map(cache)
+        try:
+            fft_map.gns.read(os.path.join(map_dir, file_name))
+            for situation in range(len(fft_map.gns.situations)):
+                fft_map.set_situation(situation)
+                fft_map.read()
+        except (OSError, KeyError, ValueError, SystemExit) as error:
+            # GNS.read exits when the file cannot be opened.
+            print("Unable to cache", file_name, error)
+            continue
+        finally:
+            resource_pool.clear()
+        print(file_name, len(fft_map.gns.situations), "situations")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the Ganesha map cache.")
+    parser.add_argument("map_dir", help="directory holding the GNS and map files")
+    parser.add_argument("--cache-dir", default=None, help="cache location")
+    args = parser.parse_args()
+    warm(args.map_dir, MapCache(args.cache_dir, background=False))
+
+
+if __name__ == "__main__":
+    main()
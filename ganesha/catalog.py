@@ -0,0 +1,203 @@
+"""Catalog of the maps in a directory.
+
+Scanning parses every GNS file (in parallel) and records its situations,
+the resolved texture and resource files of each situation, and the size,
+mtime and SHA-1 of the GNS files and the map files they reference. Other
+files in the directory are ignored. The catalog is saved next to the map
+cache and refreshed incrementally: only files whose size or mtime changed
+are parsed or hashed again. start() does this on a background thread;
+until it is done, next_listed_map walks the plain directory listing.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ganesha.cache import default_cache_dir, file_hash
+from ganesha.gns import GNS
+
+VERSION = 1
+
+
+def is_gns(file_name):
+    return file_name[-4:] in [".gns", ".GNS"]
+
+
+def file_stat(file_path):
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def base_names(files):
+    return [os.path.basename(file_path) for file_path in files]
+
+
+def read_gns(file_path):
+    gns = GNS()
+    gns.read(file_path)
+    return {
+        "situations": [list(situation) for situation in gns.situations],
+        "texture_files": [base_names(files) for files in gns.texture_files],
+        "resource_files": [base_names(files) for files in gns.resource_files],
+    }
+
+
+def next_listed_map(gns_path, step=1):
+    """The GNS path `step` places after `gns_path` in its directory."""
+    map_dir = os.path.dirname(os.path.abspath(gns_path))
+    names = sorted(x for x in os.listdir(map_dir) if is_gns(x))
+    name = os.path.basename(gns_path)
+    if name not in names:
+        return None
+    i = (names.index(name) + step) % len(names)
+    return os.path.join(map_dir, names[i])
+
+
+class MapCatalog:
+    def __init__(self, map_dir, cache_dir=None, workers=None):
+        self.map_dir = os.path.abspath(map_dir)
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.workers = workers
+        self.maps = {}
+        self.files = {}
+        # Set once load() has finished.
+        self.ready = threading.Event()
+
+    @property
+    def catalog_path(self):
+        name = hashlib.sha1(self.map_dir.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".catalog.json")
+
+    def load(self):
+        """Read the saved catalog, then bring it up to date."""
+        try:
+            with open(self.catalog_path, "r") as file:
+                catalog = json.load(file)
+            if catalog["version"] == VERSION:
+                self.maps = catalog["maps"]
+                self.files = catalog["files"]
+        except (OSError, ValueError, KeyError):
+            self.maps = {}
+            self.files = {}
+        if self.refresh():
+            self.save()
+        self.ready.set()
+        return self
+
+    def start(self):
+        """Load on a background thread; check `ready` before using it."""
+        thread = threading.Thread(target=self.load, daemon=True)
+        thread.start()
+        return self
+
+    def save(self):
+        catalog = {"version": VERSION, "maps": self.maps, "files": self.files}
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = "{}.{}.{}.tmp".format(
+                self.catalog_path, os.getpid(), threading.get_ident()
+            )
+            with open(temp_path, "w") as file:
+                json.dump(catalog, file)
+            os.replace(temp_path, self.catalog_path)
+        except OSError as error:
+            print("Unable to write map catalog:", error)
+
+    def refresh(self):
+        """Re-parse and re-hash only what changed. Returns True if anything did."""
+        gns_stats = self.stats(x for x in os.listdir(self.map_dir) if is_gns(x))
+        gns_changed = [
+            name
+            for name in sorted(gns_stats)
+            if not self.unchanged(self.files.get(name), gns_stats[name])
+        ]
+        gns_removed = [name for name in self.maps if name not in gns_stats]
+        for name in gns_removed:
+            del self.maps[name]
+        gns_paths = [os.path.join(self.map_dir, name) for name in gns_changed]
+        with ThreadPoolExecutor(self.workers) as executor:
+            entries = list(executor.map(self.read_gns, gns_paths))
+            for (name, entry) in zip(gns_changed, entries):
+                if entry is None:
+                    self.maps.pop(name, None)
+                else:
+                    self.maps[name] = entry
+
+            # Only the GNS files and the files they reference are hashed.
+            referenced = set()
+            for entry in self.maps.values():
+                for files in entry["texture_files"] + entry["resource_files"]:
+                    referenced.update(files)
+            stats = dict(self.stats(referenced - set(gns_stats)), **gns_stats)
+            changed = [
+                name
+                for name in sorted(stats)
+                if not self.unchanged(self.files.get(name), stats[name])
+            ]
+            removed = [name for name in self.files if name not in stats]
+            if not changed and not removed and not gns_removed:
+                return False
+            paths = [os.path.join(self.map_dir, name) for name in changed]
+            hashes = list(executor.map(file_hash, paths))
+        for name in removed:
+            del self.files[name]
+        for (name, sha1) in zip(changed, hashes):
+            self.files[name] = dict(stats[name], sha1=sha1)
+        return True
+
+    def stats(self, names):
+        stats = {}
+        for file_name in names:
+            file_path = os.path.join(self.map_dir, file_name)
+            if os.path.isfile(file_path):
+                stats[file_name] = file_stat(file_path)
+        return stats
+
+    def unchanged(self, entry, stat):
+        if entry is None:
+            return False
+        return entry["size"] == stat["size"] and entry["mtime"] == stat["mtime"]
+
+    def read_gns(self, file_path):
+        try:
+            return read_gns(file_path)
+        except (OSError, KeyError, ValueError) as error:
+            print("Unable to catalog", file_path, error)
+            return None
+        except SystemExit:
+            # GNS.read exits when the file cannot be opened.
+            return None
+
+    def map_paths(self):
+        return [os.path.join(self.map_dir, name) for name in sorted(self.maps)]
+
+    def next_map(self, gns_path, step=1):
+        """The GNS path `step` places after `gns_path`, wrapping around."""
+        name = os.path.basename(gns_path)
+        if name not in self.maps:
+            # Not catalogued (it failed to parse); list the directory instead.
+            return next_listed_map(os.path.join(self.map_dir, name), step)
+        names = sorted(self.maps)
+        i = (names.index(name) + step) % len(names)
+        return os.path.join(self.map_dir, names[i])
+
+    def situations(self, gns_path):
+        entry = self.maps[os.path.basename(gns_path)]
+        return [tuple(situation) for situation in entry["situations"]]
+
+    def texture_files(self, gns_path, situation):
+        entry = self.maps[os.path.basename(gns_path)]
+        return [
+            os.path.join(self.map_dir, x) for x in entry["texture_files"][situation]
+        ]
+
+    def resource_files(self, gns_path, situation):
+        entry = self.maps[os.path.basename(gns_path)]
+        return [
+            os.path.join(self.map_dir, x) for x in entry["resource_files"][situation]
+        ]
+
+    def file_info(self, file_path):
+        return self.files.get(os.path.basename(file_path))
@@ -0,0 +1,162 @@
+"""Read map files straight out of a PSX disc image.
+
+Both raw 2352-byte-sector images (BIN, Mode 1 or Mode 2 Form 1) and plain
+2048-byte-sector images (ISO) are supported. The image is memory-mapped
+and files are addressed by LBA and size, exactly as GNS records store
+them, so nothing has to be extracted first.
+
+A path into an image is written "IMAGE:DIR/FILE", e.g.
+"FFT.BIN:MAP/MAP001.GNS".
+"""
+
+import mmap
+import os
+from collections import OrderedDict, namedtuple
+from struct import unpack
+
+SECTOR_SIZE = 2048
+RAW_SECTOR_SIZE = 2352
+SYNC = b"\x00" + b"\xff" * 10 + b"\x00"
+PVD_LBA = 16
+SECTOR_CACHE_SIZE = 64
+IMAGE_EXTENSIONS = [".bin", ".img", ".iso"]
+
+DiscRecord = namedtuple("DiscRecord", ["name", "lba", "size", "is_dir"])
+
+
+class DiscImage:
+    def __init__(self, file_path, cache_size=SECTOR_CACHE_SIZE):
+        self.file_path = os.path.abspath(file_path)
+        with open(self.file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.version = (stat.st_size, stat.st_mtime_ns)
+        self.cache_size = cache_size
+        self.sectors = OrderedDict()
+
+        self.raw = False
+        self.data_offset = 0
+        raw_pvd = PVD_LBA * RAW_SECTOR_SIZE
+        if self.mmap[raw_pvd : raw_pvd + len(SYNC)] == SYNC:
+            self.raw = True
+            mode = self.mmap[raw_pvd + 15]
+            self.data_offset = 16 if mode == 1 else 24
+        pvd = self.read_sector(PVD_LBA)
+        if pvd[1:6] != b"CD001":
+            raise ValueError("Not an ISO 9660 disc image: " + self.file_path)
+        self.root = self.parse_record(pvd[156:190])
+
+    def read_sector(self, lba):
+        """The 2048 bytes of user data in sector `lba`."""
+        if not self.raw:
+            begin = lba * SECTOR_SIZE
+            return memoryview(self.mmap)[begin : begin + SECTOR_SIZE]
+        if lba in self.sectors:
+            self.sectors.move_to_end(lba)
+            return self.sectors[lba]
+        begin = lba * RAW_SECTOR_SIZE + self.data_offset
+        sector = self.mmap[begin : begin + SECTOR_SIZE]
+        self.sectors[lba] = sector
+        if len(self.sectors) > self.cache_size:
+            self.sectors.popitem(last=False)
+        return sector
+
+    def read(self, lba, size):
+        """`size` bytes of user data starting at sector `lba`.
+
+        ISO images are sliced straight out of the mapping; raw images are
+        stitched together from the sectors' user data.
+        """
+        if not self.raw:
+            begin = lba * SECTOR_SIZE
+            return memoryview(self.mmap)[begin : begin + size]
+        count = (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+        data = b"".join(self.read_sector(lba + i) for i in range(count))
+        return memoryview(data)[:size]
+
+    def parse_record(self, record):
+        (lba,) = unpack("<I", record[2:6])
+        (size,) = unpack("<I", record[10:14])
+        flags = record[25]
+        name = bytes(record[33 : 33 + record[32]]).decode("ascii", "replace")
+        return DiscRecord(name.split(";")[0], lba, size, bool(flags & 0x02))
+
+    def records(self, directory):
+        data = self.read(directory.lba, directory.size)
+        offset = 0
+        while offset < len(data):
+            record_size = data[offset]
+            if record_size == 0:
+                # Records never cross a sector boundary; skip the padding.
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            record = self.parse_record(data[offset : offset + record_size])
+            if record.name not in ["\x00", "\x01"]:
+                yield record
+            offset += record_size
+
+    def find(self, file_path):
+        record = self.root
+        for name in [x for x in file_path.replace("\\", "/").split("/") if x]:
+            if not record.is_dir:
+                record = None
+                break
+            records = [x for x in self.records(record) if x.name == name.upper()]
+            record = records[0] if records else None
+            if record is None:
+                break
+        if record is None:
+            raise FileNotFoundError("{}:{}".format(self.file_path, file_path))
+        return record
+
+    def listdir(self, directory=""):
+        return [record.name for record in self.records(self.find(directory))]
+
+    def open(self, file_path):
+        record = self.find(file_path)
+        return DiscFile(self, record.lba, record.size, file_path)
+
+
+class DiscFile:
+    """A file inside a disc image, located by LBA and size."""
+
+    def __init__(self, disc, lba, size, name=None):
+        self.disc = disc
+        self.lba = lba
+        self.size = size
+        self.name = name or "@{}".format(lba)
+
+    def __repr__(self):
+        return "{}:{}".format(self.disc.file_path, self.name)
+
+    @property
+    def key(self):
+        return (self.disc.file_path, self.lba, self.size)
+
+    @property
+    def version(self):
+        return self.disc.version
+
+    def read(self):
+        return self.disc.read(self.lba, self.size)
+
+
+discs = {}
+
+
+def open_disc(file_path):
+    """Open a disc image, reusing the mapping while the file is unchanged."""
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    disc = discs.get(file_path)
+    if disc is None or disc.version != (stat.st_size, stat.st_mtime_ns):
+        disc = discs[file_path] = DiscImage(file_path)
+    return disc
+
+
+def split_disc_path(file_path):
+    """Split "IMAGE:DIR/FILE" into its parts, or return None for a plain path."""
+    (image_path, sep, inner_path) = file_path.rpartition(":")
+    if not sep or os.path.splitext(image_path)[1].lower() not in IMAGE_EXTENSIONS:
+        return None
+    return (image_path, inner_path)
@@ -1,143 +1,438 @@
+from collections import Counter
 from math import sqrt
 
 from struct import unpack
 
+import numpy as np
+
 from ganesha.gns import GNS
 from ganesha.resource import Resources
 from ganesha.texture import Texture as Texture_File
+from ganesha.writer import MapWriter
+
+XYZ_3GON = np.dtype(("<i2", (3, 3)))
+XYZ_4GON = np.dtype(("<i2", (4, 3)))
+UV_3GON = np.dtype(
+    [
+        ("A", "u1", (2,)),
+        ("palette", "u1"),
+        ("unknown2", "u1"),
+        ("B", "u1", (2,)),
+        ("page", "u1"),
+        ("unknown4", "u1"),
+        ("C", "u1", (2,)),
+    ]
+)
+UV_4GON = np.dtype(UV_3GON.descr + [("D", "u1", (2,))])
+TERRAIN_COORDS = np.dtype([("z_level", "u1"), ("x", "u1")])
+UNKNOWN = np.dtype(("u1", (4,)))
+TILE = np.dtype(
+    [
+        ("unknown1", "u1"),
+        ("surface_type", "u1"),
+        ("unknown2", "u1"),
+        ("height", "u1"),
+        ("depth", "u1"),
+        ("slope_height", "u1"),
+        ("slope_type", "u1"),
+        ("unknown3", "u1"),
+        ("unknown4", "u1"),
+        ("cant_walk", "u1"),
+        ("cant_cursor", "u1"),
+        ("unknown5", "u1"),
+    ]
+)
+
+# Where the map texture and the palettes (CLUTs) live in PSX VRAM. Each
+# 4bpp texture page is 64 VRAM halfwords (256 texels) wide.
+TEXTURE_VRAM_X = 0x200
+PALETTE_VRAM_Y = 0x1E0
+
+# Texture animation modes
+ANIM_OFF = 0x00
+ANIM_LOOP = 0x01
+ANIM_PING_PONG = 0x02
+
+
+def is_visible_from(vis, angle):
+    """Test one of the 16 camera angles in a vis mask (angle 0 is the MSB).
+
+    Works on a single mask or on a whole array of masks at once.
+    """
+    return (vis >> (15 - angle)) & 1 == 1
+
+
+def visible_angles(vis):
+    return [(vis >> (15 - angle)) & 1 for angle in range(16)]
 
 
 class PointXYZ:
-    def __init__(self, data):
-        self.coords = (self.X, self.Y, self.Z) = unpack("<3h", data)
+    __slots__ = ("X", "Y", "Z")
+
+    def __init__(self, X, Y, Z):
+        (self.X, self.Y, self.Z) = (X, Y, Z)
+
+    @property
+    def coords(self):
+        return (self.X, self.Y, self.Z)
 
 
 class PointUV:
-    def __init__(self, data):
-        self.coords = (self.U, self.V) = unpack("<2B", data)
+    __slots__ = ("U", "V")
 
+    def __init__(self, U, V):
+        (self.U, self.V) = (U, V)
 
-class VectorXYZ:
-    def __init__(self, data):
-        self.coords = (self.X, self.Y, self.Z) = [
-            x / 4096.0 for x in unpack("<3h", data)
-        ]
+    @property
+    def coords(self):
+        return (self.U, self.V)
 
 
-class Vertex:
-    def __init__(self, point_data, normal_data=None, texcoord_data=None):
-        self.point = PointXYZ(point_data)
-        self.normal = VectorXYZ(normal_data) if normal_data else None
-        self.texcoord = PointUV(texcoord_data) if texcoord_data else None
+class VectorXYZ(PointXYZ):
+    __slots__ = ()
 
 
-class Triangle:
-    def __init__(
-        self,
-        point,
-        visangle,
-        normal=None,
-        texcoord=None,
-        unknown5=None,
-        terrain_coords=None,
-    ):
-        self.texture_palette = None
-        self.texture_page = None
-        self.visible_angles = None
-        self.terrain_coords = None
-        self.unknown1 = None
-        self.unknown2 = None
-        self.unknown3 = None
-        self.unknown4 = None
-        self.unknown5 = None
-
-        if normal:
-            self.A = Vertex(point[0:6], normal[0:6], texcoord[0:2])
-            self.unknown1 = (unpack("B", texcoord[2:3])[0] >> 4) & 0xF
-            self.texture_palette = unpack("B", texcoord[2:3])[0] & 0xF
-            self.unknown2 = unpack("B", texcoord[3:4])[0]
-            self.B = Vertex(point[6:12], normal[6:12], texcoord[4:6])
-            self.unknown3 = (unpack("B", texcoord[6:7])[0] >> 2) & 0x3F
-            self.texture_page = unpack("B", texcoord[6:7])[0] & 0x3
-            self.unknown4 = unpack("B", texcoord[7:8])[0]
-            self.C = Vertex(point[12:18], normal[12:18], texcoord[8:10])
-            (val1, tx) = unpack("BB", terrain_coords)
-            tz = val1 >> 1
-            tlvl = val1 & 0x01
-            self.terrain_coords = (tx, tz, tlvl)
-        else:
-            self.A = Vertex(point[0:6])
-            self.B = Vertex(point[6:12])
-            self.C = Vertex(point[12:18])
-            self.unknown5 = unknown5
-        vis = unpack("H", visangle)[0]
-        self.visible_angles = [(vis & 2 ** (15 - x)) >> (15 - x) for x in range(16)]
+class Vertex:
+    """One corner of a polygon, read from the group's arrays on access."""
+
+    __slots__ = ("group", "index", "corner")
+
+    def __init__(self, group, index, corner):
+        self.group = group
+        self.index = index
+        self.corner = corner
+
+    @property
+    def point(self):
+        return PointXYZ(*self.group.xyz[self.index, self.corner].tolist())
+
+    @property
+    def normal(self):
+        if self.group.norm is None:
+            return None
+        return VectorXYZ(*(self.group.norm[self.index, self.corner] / 4096.0).tolist())
+
+    @property
+    def texcoord(self):
+        if self.group.uv is None:
+            return None
+        return PointUV(*self.group.uv[self.index]["ABCD"[self.corner]].tolist())
+
+
+class Polygon:
+    """Row view of one polygon in a PolygonGroup.
+
+    Only the group and the row index are stored; vertices and attributes
+    are read from the group's arrays when they are asked for.
+    """
+
+    __slots__ = ("group", "index")
+
+    def __init__(self, group, index):
+        self.group = group
+        self.index = index
+
+    @property
+    def A(self):
+        return Vertex(self.group, self.index, 0)
+
+    @property
+    def B(self):
+        return Vertex(self.group, self.index, 1)
+
+    @property
+    def C(self):
+        return Vertex(self.group, self.index, 2)
+
+    def uv_field(self, name):
+        if self.group.uv is None:
+            return None
+        return int(self.group.uv[name][self.index])
+
+    @property
+    def texture_palette(self):
+        palette = self.uv_field("palette")
+        return None if palette is None else palette & 0xF
+
+    @property
+    def texture_page(self):
+        page = self.uv_field("page")
+        return None if page is None else page & 0x3
+
+    @property
+    def unknown1(self):
+        palette = self.uv_field("palette")
+        return None if palette is None else (palette >> 4) & 0xF
+
+    @property
+    def unknown2(self):
+        return self.uv_field("unknown2")
+
+    @property
+    def unknown3(self):
+        page = self.uv_field("page")
+        return None if page is None else (page >> 2) & 0x3F
+
+    @property
+    def unknown4(self):
+        return self.uv_field("unknown4")
+
+    @property
+    def unknown5(self):
+        if self.group.unknown is None:
+            return None
+        return self.group.unknown[self.index].tobytes()
+
+    @property
+    def terrain_coords(self):
+        if self.group.terrain is None:
+            return None
+        (val1, tx) = self.group.terrain[self.index].tolist()
+        return (tx, val1 >> 1, val1 & 0x01)
+
+    @property
+    def vis(self):
+        return int(self.group.vis[self.index])
+
+    @property
+    def visible_angles(self):
+        return visible_angles(self.vis)
+
+    def visible_from(self, angle):
+        return is_visible_from(self.vis, angle)
 
     def vertices(self):
-        for point in "ABC":
+        for point in self.corners:
             yield getattr(self, point)
 
 
-class Quad:
+class Triangle(Polygon):
+    __slots__ = ()
+    corners = "ABC"
+
+
+class Quad(Polygon):
+    __slots__ = ()
+    corners = "ABCD"
+
+    @property
+    def D(self):
+        return Vertex(self.group, self.index, 3)
+
+
+class PolygonGroup:
+    """Columnar view of one polygon kind (e.g. textured triangles).
+
+    Every column is a NumPy view into the mesh chunk, so building a group
+    costs a few np.frombuffer calls regardless of how many polygons it has.
+    """
+
     def __init__(
-        self,
-        point,
-        visangle,
-        normal=None,
-        texcoord=None,
-        unknown5=None,
-        terrain_coords=None,
+        self, corners, xyz, vis, norm=None, uv=None, terrain=None, unknown=None
     ):
-        self.texture_palette = None
-        self.texture_page = None
-        self.visible_angles = None
-        self.terrain_coords = None
-        self.unknown1 = None
-        self.unknown2 = None
-        self.unknown3 = None
-        self.unknown4 = None
-        self.unknown5 = None
-
-        if normal:
-            self.A = Vertex(point[0:6], normal[0:6], texcoord[0:2])
-            self.unknown1 = (unpack("B", texcoord[2:3])[0] >> 4) & 0xF
-            self.texture_palette = unpack("B", texcoord[2:3])[0] & 0xF
-            self.unknown2 = unpack("B", texcoord[3:4])[0]
-            self.B = Vertex(point[6:12], normal[6:12], texcoord[4:6])
-            self.unknown3 = (unpack("B", texcoord[6:7])[0] >> 2) & 0x3F
-            self.texture_page = unpack("B", texcoord[6:7])[0] & 0x3
-            self.unknown4 = unpack("B", texcoord[7:8])[0]
-            self.C = Vertex(point[12:18], normal[12:18], texcoord[8:10])
-            self.D = Vertex(point[18:24], normal[18:24], texcoord[10:12])
-            (val1, tx) = unpack("BB", terrain_coords)
-            tz = val1 >> 1
-            tlvl = val1 & 0x01
-            self.terrain_coords = (tx, tz, tlvl)
-        else:
-            self.A = Vertex(point[0:6])
-            self.B = Vertex(point[6:12])
-            self.C = Vertex(point[12:18])
-            self.D = Vertex(point[18:24])
-            self.unknown5 = unknown5
-        vis = unpack("H", visangle)[0]
-        self.visible_angles = [(vis & 2 ** (15 - x)) >> (15 - x) for x in range(16)]
+        self.corners = corners
+        self.count = len(xyz)
+        self.xyz = xyz
+        self.vis = vis
+        self.norm = norm
+        self.uv = uv
+        self.terrain = terrain
+        self.unknown = unknown
+
+    @property
+    def textured(self):
+        return self.uv is not None
+
+    @property
+    def normals(self):
+        return self.norm / 4096.0
+
+    @property
+    def texcoords(self):
+        return np.stack([self.uv[point] for point in "ABCD"[: self.corners]], axis=1)
+
+    @property
+    def texture_palette(self):
+        return self.uv["palette"] & 0xF
+
+    @property
+    def texture_page(self):
+        return self.uv["page"] & 0x3
+
+    @property
+    def unknown1(self):
+        return (self.uv["palette"] >> 4) & 0xF
+
+    @property
+    def unknown3(self):
+        return (self.uv["page"] >> 2) & 0x3F
+
+    def visible_from(self, angle):
+        return is_visible_from(self.vis, angle)
+
+    def polygons(self):
+        polygon_type = Triangle if self.corners == 3 else Quad
+        for index in range(self.count):
+            yield polygon_type(self, index)
+
+    @property
+    def terrain_x(self):
+        return self.terrain["x"]
+
+    @property
+    def terrain_z(self):
+        return self.terrain["z_level"] >> 1
+
+    @property
+    def terrain_level(self):
+        return self.terrain["z_level"] & 0x01
+
+
+class PolygonTable:
+    """Decodes a whole mesh chunk (0x40 by default) without per-polygon work.
+
+    Polygons are split into four groups in on-disk order: textured
+    triangles, textured quads, untextured triangles and untextured quads.
+    """
+
+    dtypes = {
+        "tex_3gon_xyz": XYZ_3GON,
+        "tex_4gon_xyz": XYZ_4GON,
+        "untex_3gon_xyz": XYZ_3GON,
+        "untex_4gon_xyz": XYZ_4GON,
+        "tex_3gon_norm": XYZ_3GON,
+        "tex_4gon_norm": XYZ_4GON,
+        "tex_3gon_uv": UV_3GON,
+        "tex_4gon_uv": UV_4GON,
+        "untex_3gon_unknown": UNKNOWN,
+        "untex_4gon_unknown": UNKNOWN,
+        "tex_3gon_terrain_coords": TERRAIN_COORDS,
+        "tex_4gon_terrain_coords": TERRAIN_COORDS,
+        "tex_3gon_vis": "<u2",
+        "tex_4gon_vis": "<u2",
+        "untex_3gon_vis": "<u2",
+        "untex_4gon_vis": "<u2",
+    }
+
+    def __init__(self, data, layout, vis_data=None):
+        self.layout = layout
+        self.tex_3gon = PolygonGroup(
+            3,
+            self.read(data, "tex_3gon_xyz"),
+            self.read_vis(vis_data, "tex_3gon_vis", layout.counts[0]),
+            self.read(data, "tex_3gon_norm"),
+            self.read(data, "tex_3gon_uv"),
+            self.read(data, "tex_3gon_terrain_coords"),
+        )
+        self.tex_4gon = PolygonGroup(
+            4,
+            self.read(data, "tex_4gon_xyz"),
+            self.read_vis(vis_data, "tex_4gon_vis", layout.counts[1]),
+            self.read(data, "tex_4gon_norm"),
+            self.read(data, "tex_4gon_uv"),
+            self.read(data, "tex_4gon_terrain_coords"),
+        )
+        self.untex_3gon = PolygonGroup(
+            3,
+            self.read(data, "untex_3gon_xyz"),
+            self.read_vis(vis_data, "untex_3gon_vis", layout.counts[2]),
+            unknown=self.read(data, "untex_3gon_unknown"),
+        )
+        self.untex_4gon = PolygonGroup(
+            4,
+            self.read(data, "untex_4gon_xyz"),
+            self.read_vis(vis_data, "untex_4gon_vis", layout.counts[3]),
+            unknown=self.read(data, "untex_4gon_unknown"),
+        )
+        self.groups = (self.tex_3gon, self.tex_4gon, self.untex_3gon, self.untex_4gon)
+
+    def read(self, data, name, count=None):
+        section = self.layout.sections[name]
+        if count is None:
+            count = section.count
+        return np.frombuffer(
+            data, dtype=self.dtypes[name], count=count, offset=section.start
+        )
 
-    def vertices(self):
-        for point in "ABCD":
-            yield getattr(self, point)
+    def read_vis(self, vis_data, name, count):
+        vis = np.zeros(count, dtype="<u2")
+        if vis_data is not None:
+            n = min(count, self.layout.sections[name].count)
+            vis[:n] = self.read(vis_data, name, n)
+        return vis
 
+    def __len__(self):
+        return sum(group.count for group in self.groups)
+
+    def palettes_used(self):
+        palettes = np.concatenate(
+            [self.tex_3gon.texture_palette, self.tex_4gon.texture_palette]
+        )
+        return [int(palette) for palette in np.unique(palettes)]
+
+    def visible_from(self, angle):
+        """Boolean mask over every polygon, in on-disk group order."""
+        return np.concatenate([group.visible_from(angle) for group in self.groups])
+
+    def points(self):
+        return np.concatenate([group.xyz.reshape(-1, 3) for group in self.groups])
+
+    def extents(self):
+        points = self.points()
+        if not len(points):
+            return ((32767, 32767, 32767), (-32768, -32768, -32768))
+        return (
+            tuple(int(x) for x in points.min(axis=0)),
+            tuple(int(x) for x in points.max(axis=0)),
+        )
+
+
+class Palettes:
+    """A block of 16-color BGR555 palettes decoded in one pass.
+
+    colors is an (n, 16, 4) uint8 array of 5-bit (r, g, b) values plus the
+    1-bit alpha (STP) flag, and encodes straight back to BGR555.
+    """
 
-class Palette:
     def __init__(self, data):
-        colors = []
-        for c in range(16):
-            unpacked = unpack("H", data[c * 2 : c * 2 + 2])[0]
-            a = (unpacked >> 15) & 0x01
-            b = (unpacked >> 10) & 0x1F
-            g = (unpacked >> 5) & 0x1F
-            r = (unpacked >> 0) & 0x1F
-            colors.append((r, g, b, a))
-        self.colors = colors
+        raw = np.frombuffer(data, dtype="<u2", count=len(data) // 2)
+        raw = raw.reshape(-1, 16)
+        self.colors = np.empty(raw.shape + (4,), dtype=np.uint8)
+        self.colors[..., 0] = raw & 0x1F
+        self.colors[..., 1] = (raw >> 5) & 0x1F
+        self.colors[..., 2] = (raw >> 10) & 0x1F
+        self.colors[..., 3] = (raw >> 15) & 0x01
+
+    def __len__(self):
+        return len(self.colors)
+
+    def __getitem__(self, i):
+        return self.colors[i]
+
+    def encode(self):
+        colors = self.colors.astype("<u2")
+        raw = (
+            (colors[..., 0] & 0x1F)
+            | (colors[..., 1] & 0x1F) << 5
+            | (colors[..., 2] & 0x1F) << 10
+            | (colors[..., 3] & 0x01) << 15
+        )
+        return raw.astype("<u2").tobytes()
+
+    def export_act(self):
+        """256-entry Adobe Color Table: every palette's 8-bit RGB in turn."""
+        rgb = self.colors[..., :3].reshape(-1, 3)
+        rgb = (rgb << 3) | (rgb >> 2)
+        act = np.zeros((256, 3), dtype=np.uint8)
+        act[: len(rgb)] = rgb[:256]
+        return act.tobytes()
+
+    def import_act(self, data):
+        """Replace the colors from an ACT file, keeping the alpha flags."""
+        count = min(len(data) // 3, 256, self.colors.shape[0] * 16)
+        rgb = np.frombuffer(data, dtype=np.uint8, count=count * 3).reshape(-1, 3)
+        colors = self.colors.reshape(-1, 4)
+        colors[:count, :3] = rgb >> 3
 
 
 class Ambient_Light:
@@ -148,7 +443,7 @@ class Ambient_Light:
 class Directional_Light:
     def __init__(self, color_data, direction_data):
         self.color = unpack("3h", color_data)
-        self.direction = VectorXYZ(direction_data)
+        self.direction = VectorXYZ(*[x / 4096.0 for x in unpack("<3h", direction_data)])
 
 
 class Background:
@@ -157,109 +452,259 @@ class Background:
         self.color2 = unpack("3B", color_data[3:6])
 
 
-class Tile:
-    def __init__(self, tile_data):
-        val1 = unpack("B", tile_data[0:1])[0]
-        self.unknown1 = (val1 >> 6) & 0x3
-        self.surface_type = (val1 >> 0) & 0x3F
-        self.unknown2 = unpack("B", tile_data[1:2])[0]
-        self.height = unpack("B", tile_data[2:3])[0]
-        val4 = unpack("B", tile_data[3:4])[0]
-        self.depth = (val4 >> 5) & 0x7
-        self.slope_height = (val4 >> 0) & 0x1F
-        self.slope_type = unpack("B", tile_data[4:5])[0]
-        self.unknown3 = unpack("B", tile_data[5:6])[0]
-        val7 = unpack("B", tile_data[6:7])[0]
-        self.unknown4 = (val7 >> 2) & 0x3F
-        self.cant_walk = (val7 >> 1) & 0x1
-        self.cant_cursor = (val7 >> 0) & 0x1
-        self.unknown5 = unpack("B", tile_data[7:8])[0]
+class Terrain:
+    """Both terrain levels decoded into one (2, z, x) structured array.
 
+    tiles is a record array, so tiles[y][z][x].height still works, while
+    whole-map queries and edits can work on columns like tiles.height.
+    """
+
+    # Each level reserves room for 256 tiles of 8 bytes
+    level_size = 8 * 256
 
-class Terrain:
     def __init__(self, terrain_data):
-        self.tiles = []
-        (x_count, z_count) = unpack("2B", terrain_data[0:2])
-        offset = 2
+        (self.x_count, self.z_count) = unpack("2B", terrain_data[0:2])
+        self.data = bytes(terrain_data)
+        count = self.x_count * self.z_count
+        raw = np.empty((2, count, 8), dtype=np.uint8)
         for y in range(2):
-            level = []
-            for z in range(z_count):
-                row = []
-                for x in range(x_count):
-                    tile_data = terrain_data[offset : offset + 8]
-                    tile = Tile(tile_data)
-                    row.append(tile)
-                    offset += 8
-                level.append(row)
-            self.tiles.append(level)
-            # Skip to second level of terrain data
-            offset = 2 + 8 * 256
+            offset = 2 + y * self.level_size
+            raw[y] = np.frombuffer(
+                terrain_data, dtype=np.uint8, count=count * 8, offset=offset
+            ).reshape(count, 8)
+        raw = raw.reshape(2, self.z_count, self.x_count, 8)
+
+        tiles = np.zeros(raw.shape[:3], dtype=TILE)
+        tiles["unknown1"] = (raw[..., 0] >> 6) & 0x3
+        tiles["surface_type"] = raw[..., 0] & 0x3F
+        tiles["unknown2"] = raw[..., 1]
+        tiles["height"] = raw[..., 2]
+        tiles["depth"] = (raw[..., 3] >> 5) & 0x7
+        tiles["slope_height"] = raw[..., 3] & 0x1F
+        tiles["slope_type"] = raw[..., 4]
+        tiles["unknown3"] = raw[..., 5]
+        tiles["unknown4"] = (raw[..., 6] >> 2) & 0x3F
+        tiles["cant_walk"] = (raw[..., 6] >> 1) & 0x1
+        tiles["cant_cursor"] = raw[..., 6] & 0x1
+        tiles["unknown5"] = raw[..., 7]
+        self.tiles = tiles.view(np.recarray)
+
+    def encode(self):
+        """Pack the tiles back into the on-disk 8-bytes-per-tile layout."""
+        tiles = self.tiles
+        raw = np.empty(tiles.shape + (8,), dtype=np.uint8)
+        raw[..., 0] = (tiles.unknown1 & 0x3) << 6 | (tiles.surface_type & 0x3F)
+        raw[..., 1] = tiles.unknown2
+        raw[..., 2] = tiles.height
+        raw[..., 3] = (tiles.depth & 0x7) << 5 | (tiles.slope_height & 0x1F)
+        raw[..., 4] = tiles.slope_type
+        raw[..., 5] = tiles.unknown3
+        raw[..., 6] = (
+            (tiles.unknown4 & 0x3F) << 2
+            | (tiles.cant_walk & 0x1) << 1
+            | (tiles.cant_cursor & 0x1)
+        )
+        raw[..., 7] = tiles.unknown5
+        (z_count, x_count) = tiles.shape[1:]
+        data = bytearray(self.data)
+        data[0:2] = bytes([x_count, z_count])
+        for y in range(2):
+            level = raw[y].tobytes()
+            offset = 2 + y * self.level_size
+            data[offset : offset + len(level)] = level
+        return bytes(data)
 
 
 class Texture:
+    def __init__(self, data=None, indices=None):
+        if indices is not None:
+            self.indices = indices
+            return
+        pairs = np.frombuffer(data, dtype=np.uint8, count=1024 * 128)
+        pairs = pairs.reshape(1024, 128)
+        self.indices = np.empty((1024, 256), dtype=np.uint8)
+        self.indices[:, 0::2] = pairs & 0xF
+        self.indices[:, 1::2] = pairs >> 4
+
+    @property
+    def image(self):
+        return self.indices
+
+
+def vram_to_texture(x, y):
+    """Convert a VRAM halfword position to (x, y) in the 256x1024 texture."""
+    (page, x) = divmod(x - TEXTURE_VRAM_X, 64)
+    return (x * 4, page * 256 + y)
+
+
+class TextureAnimation:
+    """One 20-byte texture animation instruction (0x6C chunk).
+
+    UV animations copy successive frames of a texture region onto a
+    "canvas" region; frame n is stored n region-heights below the first
+    one. Palette animations, which target the CLUT rows of VRAM, cycle one
+    palette through frames taken from the palette animation chunk (0x70).
+    """
+
     def __init__(self, data):
-        self.image = []
-        for y in range(1024):
-            row = []
-            for x in range(128):
-                i = y * 128 + x
-                pair = unpack("B", data[i : i + 1])[0]
-                pix1 = (pair >> 0) & 0xF
-                pix2 = (pair >> 4) & 0xF
-                row.append(pix1)
-                row.append(pix2)
-            self.image.append(row)
+        (
+            canvas_x,
+            canvas_y,
+            width,
+            height,
+            frame_x,
+            frame_y,
+            self.unknown1,
+            self.mode,
+            self.frame_count,
+            self.unknown2,
+            self.frame_duration,
+            self.unknown3,
+        ) = unpack("<7H4BH", data)
+        self.is_palette = canvas_y >= PALETTE_VRAM_Y
+        if self.is_palette:
+            self.palette = (canvas_x // 16) % 16
+            self.first_frame = (frame_x // 16) % 16
+        else:
+            self.canvas = vram_to_texture(canvas_x, canvas_y)
+            self.frame = vram_to_texture(frame_x, frame_y)
+            self.size = (width * 4, height)
+
+    @property
+    def active(self):
+        return self.mode != ANIM_OFF and self.frame_count > 0
+
+    def frame_at(self, tick):
+        """Frame shown after `tick` 30 Hz ticks."""
+        step = tick // max(self.frame_duration, 1)
+        if self.mode == ANIM_PING_PONG and self.frame_count > 1:
+            period = 2 * (self.frame_count - 1)
+            step %= period
+            return step if step < self.frame_count else period - step
+        return step % self.frame_count
+
+    def frame_source(self, frame):
+        (x, y) = self.frame
+        return (x, y + frame * self.size[1])
 
 
 class Map:
-    def __init__(self):
+    def __init__(self, cache=None, situations=None):
         self.gns = GNS()
+        self.cache = cache
+        self.situations = situations
         self.situation = None
+        self.situation_key = None
         self.texture_files = None
         self.resource_files = None
         self.texture = Texture_File()
+        self.texture_indices = None
         self.resources = Resources()
+        self.polygon_table = None
         self.extents = None
         self.hypotenuse = None
 
+    def set_gns(self, gns):
+        """Switch to another map. Its situations share none of this map's
+        pooled files, so the cached situations of this one are dropped."""
+        if self.situations is not None:
+            self.situations.clear()
+        self.situation_key = None
+        self.gns = gns
+
     def set_situation(self, situation):
+        if self.situations is not None and self.situation_key is not None:
+            self.situations.put(self.situation_key, self.get_state(), self.nbytes())
+        self.situation_key = None
         self.situation = situation % len(self.gns.situations)
         self.texture_files = self.gns.get_texture_files(self.situation)
         self.resource_files = self.gns.get_resource_files(self.situation)
         self.texture = Texture_File()
+        self.texture_indices = None
         self.resources = Resources()
+        self.polygon_table = None
 
     def read(self):
+        self.situation_key = (self.gns.file_path, self.situation)
+        if self.situations is not None:
+            state = self.situations.get(self.situation_key)
+            if state is not None:
+                self.set_state(state)
+                return
+        if self.cache is not None and self.cache.load(self):
+            return
         self.texture.read(self.texture_files)
         self.resources.read(self.resource_files)
+        if self.cache is not None:
+            self.cache.fill(self)
+
+    def get_state(self):
+        return (self.texture, self.texture_indices, self.resources, self.polygon_table)
+
+    def set_state(self, state):
+        (self.texture, self.texture_indices, self.resources, self.polygon_table) = state
+
+    def nbytes(self):
+        if self.texture_indices is not None:
+            size = self.texture_indices.nbytes
+        else:
+            size = len(self.texture.data or b"")
+        # Files used by several situations are read once into the resource
+        # pool, so they are not charged to each situation.
+        counts = Counter(x for files in self.gns.resource_files for x in set(files))
+        shared = {x for (x, count) in counts.items() if count > 1}
+        return size + self.resources.nbytes(shared)
+
+    def get_writer(self):
+        return MapWriter(self.resource_files)
+
+    def write(self, terrain=None, color_palettes=None, gray_palettes=None):
+        """Save edited map data back to the resource files it came from.
+
+        Returns the number of bytes written.
+        """
+        writer = self.get_writer()
+        if terrain is not None:
+            writer.set_chunk(0x68, terrain.encode())
+        for (toc_offset, palettes) in [(0x44, color_palettes), (0x7C, gray_palettes)]:
+            if palettes is not None and self.resources.has_chunk(toc_offset):
+                chunk = bytes(self.resources.get_chunk(toc_offset))
+                writer.set_chunk(toc_offset, palettes.encode() + chunk[512:])
+        written = writer.save()
+        # Nothing parsed before the save may be cached or reused again.
+        if self.situations is not None:
+            self.situations.clear()
+        self.resources = Resources()
+        self.resources.read(self.resource_files)
+        self.polygon_table = None
+        return written
 
     def get_texture(self):
+        if self.texture_indices is not None:
+            return Texture(indices=self.texture_indices)
         return Texture(self.texture.data)
 
+    def get_polygon_table(self, toc_index=0x40):
+        if toc_index != 0x40:
+            return PolygonTable(
+                self.resources.get_mesh(toc_index),
+                self.resources.get_mesh_layout(toc_index),
+            )
+        if self.polygon_table is None:
+            self.polygon_table = PolygonTable(
+                self.resources.get_mesh(),
+                self.resources.get_mesh_layout(),
+                self.resources.get_vis(),
+            )
+        return self.polygon_table
+
     def get_polygons(self):
-        minx = 32767
-        miny = 32767
-        minz = 32767
-        maxx = -32768
-        maxy = -32768
-        maxz = -32768
-        polygons = (
-            list(self.get_tex_3gon())
-            + list(self.get_tex_4gon())
-            + list(self.get_untex_3gon())
-            + list(self.get_untex_4gon())
-        )
-        for polygon in polygons:
-            for vertex in polygon.vertices():
-                minx = min(minx, vertex.point.X)
-                miny = min(miny, vertex.point.Y)
-                minz = min(minz, vertex.point.Z)
-                maxx = max(maxx, vertex.point.X)
-                maxy = max(maxy, vertex.point.Y)
-                maxz = max(maxz, vertex.point.Z)
-            yield polygon
-        self.extents = ((minx, miny, minz), (maxx, maxy, maxz))
+        self.extents = self.get_polygon_table().extents()
         self.get_hypotenuse()
+        yield from self.get_tex_3gon()
+        yield from self.get_tex_4gon()
+        yield from self.get_untex_3gon()
+        yield from self.get_untex_4gon()
 
     def get_hypotenuse(self):
         size_x = abs(self.extents[1][0] - self.extents[0][0])
@@ -267,60 +712,19 @@ class Map:
         self.hypotenuse = sqrt(size_x**2 + size_z**2)
 
     def get_tex_3gon(self, toc_index=0x40):
-        points = self.resources.get_tex_3gon_xyz(toc_index)
-        if toc_index == 0x40:
-            visangles = self.resources.get_tex_3gon_vis()
-        else:
-            visangles = ["\x00\x00"] * 512
-        normals = self.resources.get_tex_3gon_norm(toc_index)
-        texcoords = self.resources.get_tex_3gon_uv(toc_index)
-        terrain_coords = self.resources.get_tex_3gon_terrain_coords(toc_index)
-        for point, visangle, normal, texcoord, terrain_coord in zip(
-            points, visangles, normals, texcoords, terrain_coords
-        ):
-            yield Triangle(
-                point, visangle, normal, texcoord, terrain_coords=terrain_coord
-            )
+        return self.get_polygon_table(toc_index).tex_3gon.polygons()
 
     def get_tex_4gon(self, toc_index=0x40):
-        points = self.resources.get_tex_4gon_xyz(toc_index)
-        if toc_index == 0x40:
-            visangles = self.resources.get_tex_4gon_vis()
-        else:
-            visangles = ["\x00\x00"] * 768
-        normals = self.resources.get_tex_4gon_norm(toc_index)
-        texcoords = self.resources.get_tex_4gon_uv(toc_index)
-        terrain_coords = self.resources.get_tex_4gon_terrain_coords(toc_index)
-        for point, visangle, normal, texcoord, terrain_coord in zip(
-            points, visangles, normals, texcoords, terrain_coords
-        ):
-            yield Quad(point, visangle, normal, texcoord, terrain_coords=terrain_coord)
+        return self.get_polygon_table(toc_index).tex_4gon.polygons()
 
     def get_untex_3gon(self, toc_index=0x40):
-        points = self.resources.get_untex_3gon_xyz(toc_index)
-        if toc_index == 0x40:
-            visangles = self.resources.get_untex_3gon_vis()
-        else:
-            visangles = ["\x00\x00"] * 64
-        unknowns = self.resources.get_untex_3gon_unknown(toc_index)
-        for point, visangle, unknown in zip(points, visangles, unknowns):
-            polygon = Triangle(point, visangle, unknown5=unknown)
-            yield polygon
+        return self.get_polygon_table(toc_index).untex_3gon.polygons()
 
     def get_untex_4gon(self, toc_index=0x40):
-        points = self.resources.get_untex_4gon_xyz(toc_index)
-        if toc_index == 0x40:
-            visangles = self.resources.get_untex_4gon_vis()
-        else:
-            visangles = ["\x00\x00"] * 256
-        unknowns = self.resources.get_untex_4gon_unknown(toc_index)
-        for point, visangle, unknown in zip(points, visangles, unknowns):
-            polygon = Quad(point, visangle, unknown5=unknown)
-            yield polygon
+        return self.get_polygon_table(toc_index).untex_4gon.polygons()
 
     def get_color_palettes(self):
-        for data in self.resources.get_color_palettes():
-            yield Palette(data)
+        return Palettes(self.resources.get_color_palettes())
 
     def get_dir_lights(self):
         colors = self.resources.get_dir_light_rgb()
@@ -338,5 +742,31 @@ class Map:
         return Terrain(self.resources.get_terrain())
 
     def get_gray_palettes(self):
-        for data in self.resources.get_gray_palettes():
-            yield Palette(data)
+        return Palettes(self.resources.get_gray_palettes())
+
+    def get_texture_anims(self):
+        if not self.resources.has_chunk(0x6C):
+            return []
+        animations = [
+            TextureAnimation(data) for data in self.resources.get_texture_anims()
+        ]
+        return [animation for animation in animations if animation.active]
+
+    def get_palette_anims(self):
+        if not self.resources.has_chunk(0x70):
+            return None
+        return Palettes(self.resources.get_palette_anims())
+
+    def get_mesh_anims(self):
+        if not self.resources.has_chunk(0x8C):
+            return None
+        return self.resources.get_mesh_anims()
+
+    def get_animated_meshes(self):
+        meshes = []
+        for toc_offset in range(0x90, 0xB0, 4):
+            mesh = None
+            if self.resources.has_chunk(toc_offset):
+                mesh = self.get_polygon_table(toc_offset)
+            meshes.append(mesh)
+        return meshes
@@ -1,6 +1,9 @@
 import os
 import struct
 import sys
+from collections import namedtuple
+
+from ganesha.disc import DiscFile
 
 INDEX1_22 = 0x22
 INDEX1_30 = 0x30
@@ -1484,60 +1487,90 @@ gnslines = {
 }
 
 
+Record = namedtuple(
+    "Record",
+    ["index1", "arrange", "time", "weather", "resource_type", "lba", "size", "path"],
+)
+RECORD = struct.Struct("<HBBH2xII4x")
+
+
 class GNS:
     def __init__(self):
         self.file_path = None
         self.file = None
+        self.disc = None
         self.situations = []
         self.items = {}
+        self.records = []
+        self.texture_files = []
+        self.resource_files = []
 
     def read(self, file_path):
         self.file_path = file_path
+        self.disc = None
         map_number = int(self.file_path[-7:-4])
         try:
-            self.file = open(self.file_path, "rb")
+            with open(self.file_path, "rb") as file:
+                data = file.read()
         except IOError:
             print("Unable to open file", self.file_path)
             sys.exit(1)
         map_dir = os.path.dirname(self.file_path)
-        line_number = 0
-        (index1, arrange, temp1, resource_type) = struct.unpack(
-            "<HBBH", self.file.read(6)
-        )
+
+        def locate(line_number, lba, size):
+            return os.path.join(map_dir, gnslines[(map_number, line_number)])
+
+        self.parse(data, locate)
+
+    def read_disc(self, disc, file_path):
+        """Read a GNS file inside a disc image.
+
+        Its map files are located by the LBA and size in each record, so no
+        extracted copies (or the gnslines table) are needed.
+        """
+        self.file_path = "{}:{}".format(disc.file_path, file_path)
+        self.disc = disc
+        data = disc.open(file_path).read()
+
+        def locate(line_number, lba, size):
+            return DiscFile(disc, lba, size, "{}@{}".format(file_path, line_number))
+
+        self.parse(data, locate)
+
+    def parse(self, data, locate):
+        self.records = []
+        self.items = {}
         situations = {}
-        while not resource_type == RESOURCE_EOF:
+        end = len(data) - len(data) % RECORD.size
+        for line_number, record in enumerate(RECORD.iter_unpack(data[:end])):
+            (index1, arrange, temp1, resource_type, lba, size) = record
+            if resource_type == RESOURCE_EOF:
+                break
             time = (temp1 >> 7) & 0x1
             weather = (temp1 >> 4) & 0x7
-            self.file.seek(2, 1)
-
-            # Temporarily unused until we start reading the ISO directly
-            _ = struct.unpack("<I", self.file.read(4))[0]  # resource_lba
-            _ = struct.unpack("<I", self.file.read(4))[0]  # resource_size
-            resource_filename = gnslines[(map_number, line_number)]
-            resource_file_path = os.path.join(map_dir, resource_filename)
-
-            situations[(index1, arrange, time, weather)] = True
+            resource_file_path = locate(line_number, lba, size)
+            situation = (index1, arrange, time, weather)
+            self.records.append(
+                Record(*situation, resource_type, lba, size, resource_file_path)
+            )
+            situations[situation] = True
             if resource_type == RESOURCE_TEXTURE:
-                self.items[(index1, arrange, time, weather, "tex")] = resource_file_path
+                self.items[situation + ("tex",)] = resource_file_path
             else:
-                self.items[(index1, arrange, time, weather, "res")] = resource_file_path
-            self.file.seek(4, 1)
-            line_number += 1
-            (index1, arrange, temp1, resource_type) = struct.unpack(
-                "<HBBH", self.file.read(6)
-            )
+                self.items[situation + ("res",)] = resource_file_path
         self.situations = sorted(situations.keys())
-        self.file.close()
+        self.texture_files = [self.find_files(x, "tex") for x in self.situations]
+        self.resource_files = [self.find_files(x, "res") for x in self.situations]
 
-    def get_texture_files(self, situation):
-        (index1, arrange, time, weather) = self.situations[situation]
+    def find_files(self, situation, kind):
+        (index1, arrange, time, weather) = situation
         search_items = [
-            (index1, arrange, time, weather, "tex"),
-            (index1, arrange, TIME_0, WEATHER_0, "tex"),
-            (index1, ARRANGE_0, TIME_0, WEATHER_0, "tex"),
-            (INDEX1_70, ARRANGE_0, TIME_0, WEATHER_0, "tex"),
-            (INDEX1_30, ARRANGE_0, TIME_0, WEATHER_0, "tex"),
-            (INDEX1_22, ARRANGE_0, TIME_0, WEATHER_0, "tex"),
+            (index1, arrange, time, weather, kind),
+            (index1, arrange, TIME_0, WEATHER_0, kind),
+            (index1, ARRANGE_0, TIME_0, WEATHER_0, kind),
+            (INDEX1_70, ARRANGE_0, TIME_0, WEATHER_0, kind),
+            (INDEX1_30, ARRANGE_0, TIME_0, WEATHER_0, kind),
+            (INDEX1_22, ARRANGE_0, TIME_0, WEATHER_0, kind),
         ]
         found = []
         for key in search_items:
@@ -1545,18 +1578,8 @@ class GNS:
                 found.append(self.items[key])
         return found
 
+    def get_texture_files(self, situation):
+        return self.texture_files[situation]
+
     def get_resource_files(self, situation):
-        (index1, arrange, time, weather) = self.situations[situation]
-        search_items = [
-            (index1, arrange, time, weather, "res"),
-            (index1, arrange, TIME_0, WEATHER_0, "res"),
-            (index1, ARRANGE_0, TIME_0, WEATHER_0, "res"),
-            (INDEX1_70, ARRANGE_0, TIME_0, WEATHER_0, "res"),
-            (INDEX1_30, ARRANGE_0, TIME_0, WEATHER_0, "res"),
-            (INDEX1_22, ARRANGE_0, TIME_0, WEATHER_0, "res"),
-        ]
-        found = []
-        for key in search_items:
-            if key in self.items and self.items[key] not in found:
-                found.append(self.items[key])
-        return found
+        return self.resource_files[situation]
@@ -0,0 +1,127 @@
+"""Index buffer optimization for the batched map mesh.
+
+weld merges vertices whose attributes are byte-for-byte identical, so
+corners shared by neighbouring polygons are stored and shaded once.
+cache_order reorders triangles for a post-transform vertex cache with
+Tipsify (Sander, Nehab and Barczak, "Fast Triangle Reordering for Vertex
+Locality and Reduced Overdraw"), and vertices are then renumbered in the
+order the triangles first use them.
+"""
+
+import numpy as np
+
+# Post-transform cache size the triangle order is tuned for.
+CACHE_SIZE = 16
+
+
+def weld(vertices, indices, key_size):
+    """Merge vertices whose first `key_size` bytes are equal.
+
+    Returns the unique vertices, in order of first occurrence, and the
+    indices remapped onto them.
+    """
+    rows = vertices.view(np.uint8).reshape(len(vertices), -1)[:, :key_size]
+    keys = np.ascontiguousarray(rows).view("V{}".format(key_size)).ravel()
+    (_, first, inverse) = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    remap = np.empty(len(order), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return (vertices[first[order]], remap[inverse.ravel()][indices])
+
+
+def cache_order(triangles, vertex_count, cache_size=CACHE_SIZE):
+    """Tipsify: the order to draw `triangles` ((n, 3) indices) in."""
+    count = len(triangles)
+    corners = triangles.ravel()
+    # Triangles using each vertex, as a CSR adjacency list.
+    by_vertex = np.argsort(corners, kind="stable") // 3
+    starts = np.concatenate(
+        [[0], np.cumsum(np.bincount(corners, minlength=vertex_count))]
+    )
+    by_vertex = by_vertex.tolist()
+    starts = starts.tolist()
+    triangles = triangles.tolist()
+    live = np.bincount(corners, minlength=vertex_count).tolist()
+    stamps = [0] * vertex_count
+    emitted = [False] * count
+    order = []
+    dead_end = []
+    time = cache_size + 1
+    cursor = 0
+    vertex = 0 if count else -1
+    while vertex >= 0:
+        candidates = []
+        for triangle in by_vertex[starts[vertex] : starts[vertex + 1]]:
+            if emitted[triangle]:
+                continue
+            emitted[triangle] = True
+            order.append(triangle)
+            for corner in triangles[triangle]:
+                dead_end.append(corner)
+                candidates.append(corner)
+                live[corner] -= 1
+                if time - stamps[corner] > cache_size:
+                    stamps[corner] = time
+                    time += 1
+        # Next fan: the candidate still in cache with the most work left.
+        vertex = -1
+        best = -1
+        for candidate in candidates:
+            if live[candidate] <= 0:
+                continue
+            priority = 0
+            if time - stamps[candidate] + 2 * live[candidate] <= cache_size:
+                priority = time - stamps[candidate]
+            if priority > best:
+                (best, vertex) = (priority, candidate)
+        while vertex < 0 and dead_end:
+            candidate = dead_end.pop()
+            if live[candidate] > 0:
+                vertex = candidate
+        while vertex < 0 and cursor < vertex_count:
+            if live[cursor] > 0:
+                vertex = cursor
+            cursor += 1
+    return np.array(order, dtype=np.int64)
+
+
+def first_use_order(indices, vertex_count):
+    """Renumber vertices in the order the index buffer first uses them."""
+    (_, first) = np.unique(indices.ravel(), return_index=True)
+    order = np.argsort(first)
+    remap = np.empty(vertex_count, dtype=np.int64)
+    remap[order] = np.arange(vertex_count)
+    return (order, remap[indices])
+
+
+def miss_ratio(indices, cache_size=CACHE_SIZE):
+    """Average FIFO cache misses per triangle (ACMR)."""
+    if not len(indices):
+        return 0.0
+    cache = []
+    misses = 0
+    for index in indices.ravel().tolist():
+        if index not in cache:
+            misses += 1
+            cache.append(index)
+            if len(cache) > cache_size:
+                cache.pop(0)
+    return misses / (indices.size / 3)
+
+
+def optimize(vertices, triangles, key_size):
+    """Weld, cache-order and renumber a triangle list.
+
+    Returns (vertices, triangles, order, stats): `order` maps each output
+    triangle back to its input row, and `stats` holds vertex and index
+    counts and the ACMR before and after.
+    """
+    before = (len(vertices), triangles.size, miss_ratio(triangles))
+    (vertices, triangles) = weld(vertices, triangles, key_size)
+    order = cache_order(triangles, len(vertices))
+    triangles = triangles[order]
+    (vertex_order, triangles) = first_use_order(triangles, len(vertices))
+    vertices = vertices[vertex_order]
+    after = (len(vertices), triangles.size, miss_ratio(triangles))
+    stats = dict(zip(["vertices", "indices", "acmr"], zip(before, after)))
+    return (vertices, triangles, order, stats)
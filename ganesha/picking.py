@@ -0,0 +1,298 @@
+"""Ray picking against the map mesh on the CPU.
+
+BVH is a bounding volume hierarchy over the mesh triangles, built once when
+a map is loaded. A ray only visits the boxes it passes through, nearest
+first, so a pick costs roughly log(n) box tests plus a few leaves of
+triangle tests. When triangles move, refit recomputes the boxes of their
+leaves and of those leaves' ancestors, leaving the tree shape alone.
+
+GridPicker does the same for the terrain, whose tiles already form a
+regular grid: the ray is walked across the grid and only the tiles it
+crosses are tested.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+LEAF_SIZE = 8
+# Stands in for 1 / 0 in the slab test, keeping the products finite.
+HUGE = 1e30
+
+# barycentric weighs the triangle's corners (in the order they were given)
+# to give point.
+Hit = namedtuple("Hit", ["polygon_id", "triangle", "distance", "point", "barycentric"])
+
+
+def intersect_triangles(origin, direction, a, edge1, edge2):
+    """Möller-Trumbore against many triangles, hitting both faces.
+
+    Returns (t, u, v) arrays; t is inf where the ray misses.
+    """
+    p = np.cross(direction, edge2)
+    det = np.einsum("ij,ij->i", edge1, p)
+    valid = np.abs(det) > 1e-9
+    inv_det = np.where(valid, 1.0 / np.where(valid, det, 1.0), 0.0)
+    s = origin - a
+    u = np.einsum("ij,ij->i", s, p) * inv_det
+    q = np.cross(s, edge1)
+    v = (q @ direction) * inv_det
+    t = np.einsum("ij,ij->i", edge2, q) * inv_det
+    hit = valid & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > 0.0)
+    return (np.where(hit, t, np.inf), u, v)
+
+
+class BVH:
+    def __init__(self, triangles, polygon_ids, leaf_size=LEAF_SIZE):
+        """`triangles` is an (n, 3, 3) array of corner positions and
+        `polygon_ids` the polygon each triangle belongs to."""
+        triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        self.polygon_ids = np.asarray(polygon_ids)
+        self.leaf_size = leaf_size
+        self.lo = []
+        self.hi = []
+        self.right = []
+        self.first = []
+        self.count = []
+        self.parent = []
+        rows = []
+        if len(triangles):
+            centroids = triangles.mean(axis=1)
+            self.split(triangles, centroids, np.arange(len(triangles)), -1, rows)
+        # Triangles are stored in leaf order; position maps a caller's row
+        # to its place in that order.
+        self.rows = np.array(rows, dtype=np.int64)
+        self.position = np.empty(len(rows), dtype=np.int64)
+        self.position[self.rows] = np.arange(len(rows))
+        self.leaf = np.empty(len(rows), dtype=np.int64)
+        for (node, count) in enumerate(self.count):
+            if count:
+                self.leaf[self.first[node] : self.first[node] + count] = node
+        self.set_triangles(triangles[self.rows] if len(rows) else triangles)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def split(self, triangles, centroids, rows, parent, order):
+        node = len(self.count)
+        corners = triangles[rows].reshape(-1, 3)
+        self.lo.append(corners.min(axis=0).tolist())
+        self.hi.append(corners.max(axis=0).tolist())
+        self.right.append(-1)
+        self.first.append(len(order))
+        self.count.append(0)
+        self.parent.append(parent)
+        if len(rows) <= self.leaf_size:
+            self.count[node] = len(rows)
+            order.extend(rows.tolist())
+            return node
+        # Median split on the axis the centroids spread furthest along.
+        axis = int(np.argmax(np.ptp(centroids[rows], axis=0)))
+        middle = len(rows) // 2
+        part = np.argpartition(centroids[rows, axis], middle)
+        self.split(triangles, centroids, rows[part[:middle]], node, order)
+        self.right[node] = self.split(
+            triangles, centroids, rows[part[middle:]], node, order
+        )
+        return node
+
+    def set_triangles(self, triangles):
+        self.a = triangles[:, 0].copy()
+        self.edge1 = triangles[:, 1] - triangles[:, 0]
+        self.edge2 = triangles[:, 2] - triangles[:, 0]
+
+    def refit(self, rows, triangles):
+        """Move triangles `rows` to new (len(rows), 3, 3) corner positions
+        and grow or shrink only the boxes that hold them."""
+        rows = np.asarray(rows, dtype=np.int64)
+        triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        positions = self.position[rows]
+        self.a[positions] = triangles[:, 0]
+        self.edge1[positions] = triangles[:, 1] - triangles[:, 0]
+        self.edge2[positions] = triangles[:, 2] - triangles[:, 0]
+        nodes = set(self.leaf[positions].tolist())
+        while nodes:
+            parents = set()
+            for node in nodes:
+                if self.update_bounds(node) and self.parent[node] >= 0:
+                    parents.add(self.parent[node])
+            nodes = parents
+
+    def update_bounds(self, node):
+        """Recompute one box from its triangles or children. Returns True
+        if it changed."""
+        if self.count[node]:
+            begin = self.first[node]
+            end = begin + self.count[node]
+            a = self.a[begin:end]
+            corners = np.concatenate(
+                [a, a + self.edge1[begin:end], a + self.edge2[begin:end]]
+            )
+            (lo, hi) = (corners.min(axis=0).tolist(), corners.max(axis=0).tolist())
+        else:
+            (left, right) = (node + 1, self.right[node])
+            lo = [min(x, y) for (x, y) in zip(self.lo[left], self.lo[right])]
+            hi = [max(x, y) for (x, y) in zip(self.hi[left], self.hi[right])]
+        if lo == self.lo[node] and hi == self.hi[node]:
+            return False
+        self.lo[node] = lo
+        self.hi[node] = hi
+        return True
+
+    def entry(self, node, origin, inverse):
+        """Distance along the ray to box `node`, or None if it is missed."""
+        near = 0.0
+        far = HUGE
+        for axis in range(3):
+            t1 = (self.lo[node][axis] - origin[axis]) * inverse[axis]
+            t2 = (self.hi[node][axis] - origin[axis]) * inverse[axis]
+            if t1 > t2:
+                (t1, t2) = (t2, t1)
+            near = max(near, t1)
+            far = min(far, t2)
+            if near > far:
+                return None
+        return near
+
+    def intersect(self, origin, direction):
+        """The nearest Hit along a ray, or None."""
+        if not len(self):
+            return None
+        origin = [float(x) for x in origin]
+        direction = [float(x) for x in direction]
+        inverse = [1.0 / x if x else HUGE for x in direction]
+        ray_origin = np.array(origin)
+        ray_direction = np.array(direction)
+        best = (np.inf, -1, 0.0, 0.0)
+        stack = [(0.0, 0)]
+        while stack:
+            (near, node) = stack.pop()
+            if near >= best[0]:
+                continue
+            if self.count[node]:
+                begin = self.first[node]
+                end = begin + self.count[node]
+                (t, u, v) = intersect_triangles(
+                    ray_origin,
+                    ray_direction,
+                    self.a[begin:end],
+                    self.edge1[begin:end],
+                    self.edge2[begin:end],
+                )
+                i = int(np.argmin(t))
+                if t[i] < best[0]:
+                    best = (float(t[i]), begin + i, float(u[i]), float(v[i]))
+                continue
+            children = []
+            for child in (node + 1, self.right[node]):
+                child_near = self.entry(child, origin, inverse)
+                if child_near is not None and child_near < best[0]:
+                    children.append((child_near, child))
+            # Visit the nearer child first.
+            stack.extend(sorted(children, reverse=True))
+        (t, position, u, v) = best
+        if position < 0:
+            return None
+        row = int(self.rows[position])
+        return Hit(
+            int(self.polygon_ids[row]),
+            row,
+            t,
+            tuple((ray_origin + t * ray_direction).tolist()),
+            (1.0 - u - v, u, v),
+        )
+
+
+class GridPicker:
+    """Ray picking over a regular grid of cells, each holding a few
+    triangles on every level (like the terrain's tiles).
+
+    `triangles` is a (levels, rows, columns, k, 3, 3) array. Cell (row,
+    column) must lie inside [column * size, (column + 1) * size) by
+    [row * size, (row + 1) * size) on the x and y axes. The ray is walked
+    through the grid with a 2-D DDA, and only the cells it crosses are
+    tested.
+    """
+
+    def __init__(self, triangles, size):
+        self.triangles = triangles
+        self.size = size
+
+    def bounds(self):
+        (levels, rows, columns) = self.triangles.shape[:3]
+        heights = self.triangles[..., 2]
+        lo = (0.0, 0.0, float(heights.min()) if heights.size else 0.0)
+        hi = (columns * self.size, rows * self.size, float(heights.max()))
+        return (lo, hi)
+
+    def cells(self, origin, direction):
+        """(row, column) of every cell the ray crosses, nearest first."""
+        (levels, rows, columns) = self.triangles.shape[:3]
+        if not rows or not columns:
+            return []
+        (lo, hi) = self.bounds()
+        near = 0.0
+        far = HUGE
+        for axis in range(3):
+            if direction[axis]:
+                t1 = (lo[axis] - origin[axis]) / direction[axis]
+                t2 = (hi[axis] - origin[axis]) / direction[axis]
+                near = max(near, min(t1, t2))
+                far = min(far, max(t1, t2))
+            elif not lo[axis] <= origin[axis] <= hi[axis]:
+                return []
+        if near > far:
+            return []
+        # Amanatides & Woo: step into whichever neighbour the ray reaches first.
+        position = [origin[axis] + near * direction[axis] for axis in range(2)]
+        cell = [
+            min(max(int(position[0] // self.size), 0), columns - 1),
+            min(max(int(position[1] // self.size), 0), rows - 1),
+        ]
+        step = [0, 0]
+        t_max = [HUGE, HUGE]
+        t_delta = [HUGE, HUGE]
+        for axis in range(2):
+            if direction[axis] > 0:
+                step[axis] = 1
+                boundary = (cell[axis] + 1) * self.size
+            elif direction[axis] < 0:
+                step[axis] = -1
+                boundary = cell[axis] * self.size
+            else:
+                continue
+            t_max[axis] = (boundary - origin[axis]) / direction[axis]
+            t_delta[axis] = self.size / abs(direction[axis])
+        cells = []
+        while 0 <= cell[0] < columns and 0 <= cell[1] < rows:
+            cells.append((cell[1], cell[0]))
+            axis = 0 if t_max[0] < t_max[1] else 1
+            if t_max[axis] > far:
+                break
+            cell[axis] += step[axis]
+            t_max[axis] += t_delta[axis]
+        return cells
+
+    def intersect(self, origin, direction):
+        """(level, row, column) of the nearest cell surface hit, or None."""
+        origin = [float(x) for x in origin]
+        direction = [float(x) for x in direction]
+        cells = self.cells(origin, direction)
+        if not cells:
+            return None
+        (rows, columns) = zip(*cells)
+        # (levels, cells, k, 3, 3) -> every candidate triangle in one array
+        candidates = self.triangles[:, list(rows), list(columns)]
+        triangles = candidates.reshape(-1, 3, 3)
+        (t, _, _) = intersect_triangles(
+            np.array(origin),
+            np.array(direction),
+            triangles[:, 0],
+            triangles[:, 1] - triangles[:, 0],
+            triangles[:, 2] - triangles[:, 0],
+        )
+        i = int(np.argmin(t))
+        if np.isinf(t[i]):
+            return None
+        (level, cell, _) = np.unravel_index(i, candidates.shape[:3])
+        return (int(level), cells[cell][0], cells[cell][1])
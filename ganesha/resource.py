@@ -1,327 +1,333 @@
-from os.path import getsize
+import mmap
+import os
+from collections import namedtuple
 from struct import unpack
 
+from ganesha.disc import DiscFile
+
+
+class Section(namedtuple("Section", ["start", "stride", "count"])):
+    @property
+    def end(self):
+        return self.start + self.stride * self.count
+
+    def slices(self, data):
+        for offset in range(self.start, self.end, self.stride):
+            yield data[offset : offset + self.stride]
+
+
+class MeshLayout:
+    """Start, stride and count of every sub-section of a mesh chunk.
+
+    The header is parsed once; decoders and writers look sections up by
+    name instead of re-deriving the running offsets. The vis sections are
+    a fixed-size table at the start of the 0xB0 chunk, not the mesh chunk.
+    """
+
+    vis_sections = {
+        "tex_3gon_vis": Section(0x380, 2, 512),
+        "tex_4gon_vis": Section(0x380 + 512 * 2, 2, 768),
+        "untex_3gon_vis": Section(0x380 + 512 * 2 + 768 * 2, 2, 64),
+        "untex_4gon_vis": Section(0x380 + 512 * 2 + 768 * 2 + 64 * 2, 2, 256),
+    }
+
+    def __init__(self, data):
+        self.counts = unpack("<4H", data[0:8])
+        (tri_count, quad_count, untri_count, unquad_count) = self.counts
+        self.sections = {}
+        offset = 8
+        for name, stride, count in [
+            ("tex_3gon_xyz", 18, tri_count),
+            ("tex_4gon_xyz", 24, quad_count),
+            ("untex_3gon_xyz", 18, untri_count),
+            ("untex_4gon_xyz", 24, unquad_count),
+            ("tex_3gon_norm", 18, tri_count),
+            ("tex_4gon_norm", 24, quad_count),
+            ("tex_3gon_uv", 10, tri_count),
+            ("tex_4gon_uv", 12, quad_count),
+            ("untex_3gon_unknown", 4, untri_count),
+            ("untex_4gon_unknown", 4, unquad_count),
+            ("tex_3gon_terrain_coords", 2, tri_count),
+            ("tex_4gon_terrain_coords", 2, quad_count),
+        ]:
+            section = Section(offset, stride, count)
+            self.sections[name] = section
+            offset = section.end
+        self.size = offset
+        self.sections.update(self.vis_sections)
+
+
+def chunk_bounds(toc, size):
+    """(begin, end) of every chunk in a TOC; a chunk ends where the next
+    non-empty entry starts, or at the end of the file."""
+    bounds = [None] * len(toc)
+    for i, begin in enumerate(toc):
+        if begin == 0:
+            continue
+        end = size
+        for j in range(i + 1, len(toc)):
+            if toc[j]:
+                end = min(toc[j], size)
+                break
+        bounds[i] = (begin, max(begin, end))
+    return bounds
+
 
 class Resource:
     def __init__(self):
         super(Resource, self).__init__()
         self.file_path = None
-        self.file = None
-        self.chunks = [""] * 49
+        self.chunks = [None] * 49
+        self.bounds = [None] * 49
         self.size = None
+        self.version = None
+        self.mapped = False
+        self.mmap = None
+        self.data = None
+
+    def read(self, file_path, mapped=False):
+        """Read the TOC only; chunks are loaded by get_chunk on first use.
 
-    def read(self, file_path):
+        With mapped=True the file is memory-mapped instead of read, and each
+        chunk is a memoryview slice of the mapping rather than a copy. A
+        DiscFile is read from its disc image in one go.
+        """
         self.file_path = file_path
-        self.size = getsize(self.file_path)
-        self.file = open(self.file_path, "rb")
-        toc = list(unpack("<49I", self.file.read(0xC4)))
-        self.file.seek(0)
-        data = self.file.read()
-        self.file.close()
+        self.mapped = mapped
+        if isinstance(file_path, DiscFile):
+            self.data = file_path.read()
+            (self.size, self.version) = (len(self.data), file_path.version)
+            toc = list(unpack("<49I", self.data[0:0xC4]))
+        else:
+            with open(self.file_path, "rb") as file:
+                stat = os.fstat(file.fileno())
+                self.size = stat.st_size
+                self.version = (stat.st_size, stat.st_mtime_ns)
+                toc = list(unpack("<49I", file.read(0xC4)))
+        self.bounds = chunk_bounds(toc, self.size)
         toc.append(self.size)
-        for i, entry in enumerate(toc[:-1]):
-            begin = toc[i]
-            if begin == 0:
-                continue
-            end = None
-            for j in range(i + 1, len(toc)):
-                if toc[j]:
-                    end = toc[j]
-                    break
-            self.chunks[i] = data[begin:end]
         self.toc = toc
 
+    def has_chunk(self, i):
+        if self.bounds[i] is None:
+            return False
+        (begin, end) = self.bounds[i]
+        return end > begin
+
+    def get_chunk(self, i):
+        if self.chunks[i] is None:
+            self.chunks[i] = self.load_chunk(i)
+        return self.chunks[i]
+
+    def load_chunk(self, i):
+        if not self.has_chunk(i):
+            return b""
+        (begin, end) = self.bounds[i]
+        if self.data is not None:
+            return self.data[begin:end]
+        if self.mapped:
+            if self.mmap is None:
+                with open(self.file_path, "rb") as file:
+                    self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.mmap)[begin:end]
+        with open(self.file_path, "rb") as file:
+            file.seek(begin)
+            return file.read(end - begin)
+
+
+class ResourcePool:
+    """Resource files shared by every situation that falls back to them.
+
+    Files are keyed by path and mtime, so the common 0x22/0x30 base files
+    are read once and their loaded chunks reused. A file that changed on
+    disk is read again. Call clear() when moving on to another map.
+    """
 
-class Resources:
     def __init__(self):
+        self.resources = {}
+
+    def get(self, file_path, mapped=False):
+        if isinstance(file_path, DiscFile):
+            (key, version) = (file_path.key, file_path.version)
+        else:
+            stat = os.stat(file_path)
+            key = os.path.abspath(file_path)
+            version = (stat.st_size, stat.st_mtime_ns)
+        resource = self.resources.get((key, mapped))
+        if resource is None or resource.version != version:
+            resource = Resource()
+            resource.read(file_path, mapped)
+            self.resources[(key, mapped)] = resource
+        return resource
+
+    def __len__(self):
+        return len(self.resources)
+
+    def clear(self):
+        self.resources.clear()
+
+
+resource_pool = ResourcePool()
+
+
+class Resources:
+    def __init__(self, mapped=False, pool=resource_pool):
         super(Resources, self).__init__()
+        self.mapped = mapped
+        self.pool = pool
         self.chunks = [None] * 49
+        self.layouts = {}
 
     def read(self, files):
         for file_path in files:
-            resource = Resource()
-            resource.read(file_path)
+            if self.pool is None:
+                resource = Resource()
+                resource.read(file_path, self.mapped)
+            else:
+                resource = self.pool.get(file_path, self.mapped)
             for i in range(49):
                 if self.chunks[i] is not None:
                     continue
-                if resource.chunks[i]:
+                if resource.has_chunk(i):
                     self.chunks[i] = resource
 
-    def get_tex_3gon_xyz(self, toc_offset=0x40):
+    def set_chunks(self, chunks):
+        """Use already resolved chunk data, keyed by TOC index."""
+        resource = Resource()
+        for (i, data) in chunks.items():
+            resource.chunks[i] = data
+            resource.bounds[i] = (0, len(data))
+            self.chunks[i] = resource
+
+    def has_chunk(self, toc_offset):
+        return self.chunks[toc_offset // 4] is not None
+
+    def nbytes(self, shared=()):
+        """Size of the chunks loaded so far, leaving out those of the files
+        in `shared`."""
+        size = 0
+        for (i, resource) in enumerate(self.chunks):
+            if resource is None or resource.chunks[i] is None:
+                continue
+            if resource.file_path in shared:
+                continue
+            size += len(resource.chunks[i])
+        return size
+
+    def get_chunk(self, toc_offset):
         resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = 8
-        for i in range(tri_count):
-            polygon_data = data[offset : offset + 18]
-            yield polygon_data
-            offset += 18
+        return resource.get_chunk(toc_offset // 4)
+
+    def get_mesh(self, toc_offset=0x40):
+        return self.get_chunk(toc_offset)
+
+    def get_mesh_layout(self, toc_offset=0x40):
+        if toc_offset not in self.layouts:
+            self.layouts[toc_offset] = MeshLayout(self.get_mesh(toc_offset))
+        return self.layouts[toc_offset]
+
+    def get_tex_3gon_xyz(self, toc_offset=0x40):
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_3gon_xyz"].slices(self.get_mesh(toc_offset))
 
     def get_tex_4gon_xyz(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = 8 + tri_count * 18
-        for i in range(quad_count):
-            polygon_data = data[offset : offset + 24]
-            yield polygon_data
-            offset += 24
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_4gon_xyz"].slices(self.get_mesh(toc_offset))
 
     def get_untex_3gon_xyz(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = 8 + tri_count * 18 + quad_count * 24
-        for i in range(untri_count):
-            polygon_data = data[offset : offset + 18]
-            yield polygon_data
-            offset += 18
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["untex_3gon_xyz"].slices(self.get_mesh(toc_offset))
 
     def get_untex_4gon_xyz(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = 8 + tri_count * 18 + quad_count * 24 + untri_count * 18
-        for i in range(unquad_count):
-            polygon_data = data[offset : offset + 24]
-            yield polygon_data
-            offset += 24
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["untex_4gon_xyz"].slices(self.get_mesh(toc_offset))
 
     def get_tex_3gon_norm(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8 + tri_count * 18 + quad_count * 24 + untri_count * 18 + unquad_count * 24
-        )
-        for i in range(tri_count):
-            normal_data = data[offset : offset + 18]
-            yield normal_data
-            offset += 18
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_3gon_norm"].slices(self.get_mesh(toc_offset))
 
     def get_tex_4gon_norm(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-        )
-        for i in range(quad_count):
-            normal_data = data[offset : offset + 24]
-            yield normal_data
-            offset += 24
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_4gon_norm"].slices(self.get_mesh(toc_offset))
 
     def get_tex_3gon_uv(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-            + quad_count * 24
-        )
-        for i in range(tri_count):
-            texcoord_data = data[offset : offset + 10]
-            yield texcoord_data
-            offset += 10
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_3gon_uv"].slices(self.get_mesh(toc_offset))
 
     def get_tex_4gon_uv(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-            + quad_count * 24
-            + tri_count * 10
-        )
-        for i in range(quad_count):
-            texcoord_data = data[offset : offset + 12]
-            yield texcoord_data
-            offset += 12
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_4gon_uv"].slices(self.get_mesh(toc_offset))
 
     def get_untex_3gon_unknown(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-            + quad_count * 24
-            + tri_count * 10
-            + quad_count * 12
-        )
-        for i in range(untri_count):
-            unk_data = data[offset : offset + 4]
-            yield unk_data
-            offset += 4
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["untex_3gon_unknown"].slices(self.get_mesh(toc_offset))
 
     def get_untex_4gon_unknown(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-            + quad_count * 24
-            + tri_count * 10
-            + quad_count * 12
-            + untri_count * 4
-        )
-        for i in range(unquad_count):
-            unk_data = data[offset : offset + 4]
-            yield unk_data
-            offset += 4
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["untex_4gon_unknown"].slices(self.get_mesh(toc_offset))
 
     def get_tex_3gon_terrain_coords(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-            + quad_count * 24
-            + tri_count * 10
-            + quad_count * 12
-            + untri_count * 4
-            + unquad_count * 4
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_3gon_terrain_coords"].slices(
+            self.get_mesh(toc_offset)
         )
-        for i in range(tri_count):
-            terrain_coord_data = data[offset : offset + 2]
-            yield terrain_coord_data
-            offset += 2
 
     def get_tex_4gon_terrain_coords(self, toc_offset=0x40):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        (tri_count, quad_count, untri_count, unquad_count) = unpack("<4H", data[0:8])
-        offset = (
-            8
-            + tri_count * 18
-            + quad_count * 24
-            + untri_count * 18
-            + unquad_count * 24
-            + tri_count * 18
-            + quad_count * 24
-            + tri_count * 10
-            + quad_count * 12
-            + untri_count * 4
-            + unquad_count * 4
-            + tri_count * 2
+        layout = self.get_mesh_layout(toc_offset)
+        return layout.sections["tex_4gon_terrain_coords"].slices(
+            self.get_mesh(toc_offset)
         )
-        for i in range(quad_count):
-            terrain_coord_data = data[offset : offset + 2]
-            yield terrain_coord_data
-            offset += 2
-
-    def get_tex_3gon_vis(self, toc_offset=0xB0):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        offset = 0x380
-        for i in range(512):
-            vis_data = data[offset : offset + 2]
-            yield vis_data
-            offset += 2
-
-    def get_tex_4gon_vis(self, toc_offset=0xB0):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        offset = 0x380 + 512 * 2
-        for i in range(768):
-            vis_data = data[offset : offset + 2]
-            yield vis_data
-            offset += 2
 
-    def get_untex_3gon_vis(self, toc_offset=0xB0):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        offset = 0x380 + 512 * 2 + 768 * 2
-        for i in range(64):
-            vis_data = data[offset : offset + 2]
-            yield vis_data
-            offset += 2
-
-    def get_untex_4gon_vis(self, toc_offset=0xB0):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        offset = 0x380 + 512 * 2 + 768 * 2 + 64 * 2
-        for i in range(256):
-            vis_data = data[offset : offset + 2]
-            yield vis_data
-            offset += 2
+    def get_vis(self, toc_offset=0xB0):
+        return self.get_chunk(toc_offset)
 
     def get_color_palettes(self, toc_offset=0x44):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        offset = 0
-        for i in range(16):
-            yield data[offset : offset + 32]
-            offset += 32
+        data = self.get_chunk(toc_offset)
+        return data[0 : 16 * 32]
 
     def get_dir_light_rgb(self, toc_offset=0x64):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
+        data = self.get_chunk(toc_offset)
         offset = 0
         for i in range(3):
-            yield data[offset : offset + 2] + data[offset + 6 : offset + 8] + data[
-                offset + 12 : offset + 14
-            ]
+            yield (
+                bytes(data[offset : offset + 2])
+                + bytes(data[offset + 6 : offset + 8])
+                + bytes(data[offset + 12 : offset + 14])
+            )
             offset += 2
 
     def get_dir_light_norm(self, toc_offset=0x64):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
+        data = self.get_chunk(toc_offset)
         offset = 18
         for i in range(3):
             yield data[offset : offset + 6]
             offset += 6
 
     def get_amb_light_rgb(self, toc_offset=0x64):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
+        data = self.get_chunk(toc_offset)
         offset = 36
         return data[offset : offset + 3]
 
     def get_background(self, toc_offset=0x64):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
+        data = self.get_chunk(toc_offset)
         offset = 39
         return data[offset : offset + 6]
 
     def get_terrain(self, toc_offset=0x68):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        return data
+        return self.get_chunk(toc_offset)
+
+    def get_texture_anims(self, toc_offset=0x6C):
+        data = self.get_chunk(toc_offset)
+        for offset in range(0, len(data) - 19, 20):
+            yield data[offset : offset + 20]
+
+    def get_palette_anims(self, toc_offset=0x70):
+        data = self.get_chunk(toc_offset)
+        return data[0 : len(data) // 32 * 32]
+
+    def get_mesh_anims(self, toc_offset=0x8C):
+        return self.get_chunk(toc_offset)
 
     def get_gray_palettes(self, toc_offset=0x7C):
-        resource = self.chunks[toc_offset // 4]
-        data = resource.chunks[toc_offset // 4]
-        offset = 0
-        for i in range(16):
-            yield data[offset : offset + 32]
-            offset += 32
+        data = self.get_chunk(toc_offset)
+        return data[0 : 16 * 32]
@@ -1,3 +1,6 @@
+from ganesha.disc import DiscFile
+
+
 class Texture:
     def __init__(self):
         self.file_path = None
@@ -7,6 +10,9 @@ class Texture:
         """TODO: This seems wrong to only get the first path and bail."""
         for path in files:
             self.file_path = path
+            if isinstance(path, DiscFile):
+                self.data = bytes(path.read())
+                break
             with open(path, "rb") as file:
                 self.data = file.read()
             break
@@ -49,6 +49,7 @@ class ViewerMouse(DirectObject):
         self.prev_pos = None
         self.drag_start = None
         self.hovered_object = None
+        self.pick_key = None
 
         self.task = None
 
@@ -91,30 +92,44 @@ class ViewerMouse(DirectObject):
         return action
 
     def movement_task(self, task):
-        if self.hovered_object:
-            self.hovered_object.unhover()
-            self.hovered_object = None
         if self.button1:
             self.camera_drag()
         elif self.button3:
             self.camera_pan()
 
-        hovered_node_path = self.find_object()
-        if hovered_node_path:
-            polygon = hovered_node_path.findNetTag("polygon_i")
-            if not polygon.isEmpty():
-                tag = polygon.getTag("polygon_i")
-                i = int(tag)
-                self.hovered_object = self.app.world.polygons[i]
-                self.hovered_object.hover()
-            tile = hovered_node_path.findNetTag("terrain_xyz")
-            if not tile.isEmpty():
-                tag = tile.getTag("terrain_xyz")
-                (x, y, z) = [int(i) for i in tag.split(",")]
-                self.hovered_object = self.app.world.terrain.tiles[y][z][x]
+        # Only pick again when the mouse, the camera or the scene changed.
+        pick_key = self.get_pick_key()
+        if pick_key == self.pick_key:
+            return task.cont
+        scene_changed = self.pick_key is None or pick_key[-1] != self.pick_key[-1]
+        self.pick_key = pick_key
+        hovered_object = self.pick_object()
+        if hovered_object is None:
+            hovered_node_path = self.find_object()
+            if hovered_node_path:
+                polygon = hovered_node_path.findNetTag("polygon_i")
+                if not polygon.isEmpty():
+                    tag = polygon.getTag("polygon_i")
+                    i = int(tag)
+                    hovered_object = self.app.world.polygons[i]
+        if hovered_object is not self.hovered_object or scene_changed:
+            if self.hovered_object:
+                self.hovered_object.unhover()
+            self.hovered_object = hovered_object
+            if self.hovered_object:
                 self.hovered_object.hover()
         return task.cont
 
+    def get_pick_key(self):
+        camera = self.app.base.camera
+        return (
+            (self.pos.getX(), self.pos.getY()),
+            camera.getMat(self.app.base.render),
+            tuple(self.app.base.cam.node().getLens().getFilmSize()),
+            self.app.terrain_mode,
+            self.app.world.generation,
+        )
+
     def mouse1(self):
         self.button1 = True
         self.app.state.request("mouse1")
@@ -163,15 +178,37 @@ class ViewerMouse(DirectObject):
             scale = self.app.world.background.node_path.getScale()
             self.app.world.background.node_path.setScale(scale * 1.2)
 
+    def pick_object(self):
+        """Tile or batched Polygon under the mouse, found without the
+        collision traverser."""
+        world = self.app.world
+        if not world.node_path:
+            return None
+        self.cRay.setFromLens(self.app.base.camNode, self.pos.getX(), self.pos.getY())
+        if self.app.terrain_mode in [MOSTLY_TERRAIN, TERRAIN_ONLY]:
+            (origin, direction) = self.ray(world.node_path_terrain)
+            return world.pick_tile(origin, direction)
+        if world.batched:
+            (origin, direction) = self.ray(world.node_path_mesh)
+            return world.pick_polygon(origin, direction)
+        return None
+
+    def ray(self, node_path):
+        """The mouse ray in `node_path`'s coordinates."""
+        origin = node_path.getRelativePoint(self.cNodePath, self.cRay.getOrigin())
+        direction = node_path.getRelativeVector(
+            self.cNodePath, self.cRay.getDirection()
+        )
+        return (origin, direction)
+
     def find_object(self):
-        if self.app.world.node_path:
+        if self.app.world.node_path and not self.app.world.batched:
+            if self.app.terrain_mode not in [MESH_ONLY, MOSTLY_MESH]:
+                return None
             self.cRay.setFromLens(
                 self.app.base.camNode, self.pos.getX(), self.pos.getY()
             )
-            if self.app.terrain_mode in [MESH_ONLY, MOSTLY_MESH]:
-                self.cTrav.traverse(self.app.world.node_path_mesh)
-            elif self.app.terrain_mode in [MOSTLY_TERRAIN, TERRAIN_ONLY]:
-                self.cTrav.traverse(self.app.world.node_path_terrain)
+            self.cTrav.traverse(self.app.world.node_path_mesh)
             if self.cQueue.getNumEntries() > 0:
                 self.cQueue.sortEntries()
                 return self.cQueue.getEntry(0).getIntoNodePath()
@@ -226,6 +263,7 @@ class MapViewer(DirectObject):
         self.accept("[", self.prev_situation)
         self.accept("n", self.next_gns)
         self.accept("t", self.next_terrain_mode)
+        self.accept("control-s", self.save)
         self.accept("escape", self.open_settings_window)
 
         self.base.disableMouse()
@@ -318,11 +356,13 @@ class MapViewer(DirectObject):
         if hovered_object:
             self.selected_object = hovered_object
             self.selected_object.select()
+            self.world.touch()
 
     def unselect(self):
         if self.selected_object:
             self.selected_object.unselect()
             self.selected_object = None
+            self.world.touch()
 
     def next_situation(self):
         self.unselect()
@@ -336,6 +376,9 @@ class MapViewer(DirectObject):
         self.world.set_terrain_alpha(self.terrain_mode)
         self.set_full_light(self.full_light_enabled)
 
+    def save(self):
+        self.world.save()
+
     def next_gns(self):
         self.unselect()
         self.world.next_gns()
@@ -361,6 +404,7 @@ class SettingsWindow(wx.Frame):
         text = (
             "[: Previous state\t]: Next State\n\n"
             + "n: Next map\t\tt: Next terrain mode\n\n"
+            + "Ctrl-S: Save map\n\n"
             + "Alt-Right Click / Mouse-Wheel Click + Drag: Pan Camera\n\n"
         )
         text_label = wx.StaticText(panel, wx.ID_ANY, text)
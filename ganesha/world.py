@@ -1,25 +1,34 @@
 import os
+import time
 from math import cos, pi, sin
 
+import numpy as np
 from panda3d.core import (
     AmbientLight,
     DirectionalLight,
     Geom,
     GeomLines,
     GeomNode,
+    GeomTriangles,
     GeomTristrips,
+    GeomVertexArrayFormat,
     GeomVertexData,
     GeomVertexFormat,
     GeomVertexWriter,
+    InternalName,
     OrthographicLens,
-    PNMImage,
     Point3,
 )
 from panda3d.core import Texture as P3DTexture
-from panda3d.core import TransparencyAttrib, VBase4, VBase4F
+from panda3d.core import TextureStage, TransparencyAttrib, VBase4
 
-from ganesha import fftmap
+from ganesha import fftmap, mesh
+from ganesha.cache import MapCache, SituationCache
+from ganesha.catalog import MapCatalog, next_listed_map
 from ganesha.constants import MESH_ONLY, MOSTLY_MESH, MOSTLY_TERRAIN, TERRAIN_ONLY
+from ganesha.disc import open_disc, split_disc_path
+from ganesha.picking import BVH, GridPicker
+from ganesha.resource import resource_pool
 
 
 def coords_to_panda(x, y, z):
@@ -28,11 +37,47 @@ def coords_to_panda(x, y, z):
 
 def uv_to_panda(polygon, pal, u, v):
     page = polygon.texture_page
-    u = (u + pal) / (256.0 * 17)
+    u = (u + pal) / 256.0
     v = 1.0 - (page + v / 256.0) / 4.0
     return (u, v)
 
 
+# Vertex layout of the batched mesh; BATCH_VERTEX mirrors BATCH_FORMAT
+# byte for byte so whole arrays can be copied into Panda at once. Welding
+# shares a vertex between polygons, and it keeps the polygon_id of the first
+# one; PolygonBatch.triangle_ids has the exact polygon of every triangle.
+BATCH_VERTEX = np.dtype(
+    [
+        ("vertex", "<f4", 3),
+        ("normal", "<f4", 3),
+        ("color", "<f4", 4),
+        ("texcoord", "<f4", 2),
+        ("polygon_id", "<u4"),
+    ]
+)
+batch_array_format = GeomVertexArrayFormat()
+for (column, components, numeric_type, contents) in [
+    (InternalName.getVertex(), 3, Geom.NT_float32, Geom.C_point),
+    (InternalName.getNormal(), 3, Geom.NT_float32, Geom.C_normal),
+    (InternalName.getColor(), 4, Geom.NT_float32, Geom.C_color),
+    (InternalName.getTexcoord(), 2, Geom.NT_float32, Geom.C_texcoord),
+    (InternalName.make("polygon_id"), 1, Geom.NT_uint32, Geom.C_index),
+]:
+    batch_array_format.addColumn(column, components, numeric_type, contents)
+BATCH_FORMAT = GeomVertexFormat.registerFormat(batch_array_format)
+
+# Vertices are welded on every column but polygon_id.
+WELD_KEY_SIZE = BATCH_VERTEX.fields["polygon_id"][1]
+
+# Triangles of a polygon, as corner indices; the quad's second triangle
+# keeps the winding of the tristrip Polygon draws.
+CORNER_TRIANGLES = {3: [[0, 1, 2]], 4: [[0, 1, 2], [1, 3, 2]]}
+
+
+def copy_into(array_data, array):
+    memoryview(array_data).cast("B")[:] = np.ascontiguousarray(array).tobytes()
+
+
 global_polygon_id = 0
 
 
@@ -216,8 +261,9 @@ class Vector:
 
 
 class Polygon:
-    def __init__(self, parent, polygon):
+    def __init__(self, parent, polygon, batched=False):
         self.parent = parent
+        self.batched = batched
         self.source = None
         self.terrain_coords = None
         self.format = GeomVertexFormat.getV3n3c4t2()
@@ -241,10 +287,16 @@ class Polygon:
             self.terrain_coords = tcoords
         if polygon.A.texcoord:
             self.palette = polygon.texture_palette
-        self.init_node_path()
+        if polygon.A.normal:
+            self.old_color = (1.0, 1.0, 1.0, 1.0)
+        else:
+            self.old_color = (0.0, 0.0, 0.0, 1.0)
+        if not batched:
+            self.init_node_path()
 
     def __del__(self):
-        self.node_path.remove_node()
+        if self.node_path:
+            self.node_path.remove_node()
 
     def init_node_path(self):
         if self.node_path:
@@ -269,18 +321,14 @@ class Polygon:
             normal.addData3f(*coords_to_panda(*polygon.C.normal.coords))
             if hasattr(polygon, "D"):
                 normal.addData3f(*coords_to_panda(*polygon.D.normal.coords))
-        if polygon.A.normal:
-            gray = 1.0
-        else:
-            gray = 0.0
-        self.old_color = (gray, gray, gray, 1.0)
+        gray = self.old_color[0]
         color.addData4f(gray, gray, gray, 1.0)
         color.addData4f(gray, gray, gray, 1.0)
         color.addData4f(gray, gray, gray, 1.0)
         if hasattr(polygon, "D"):
             color.addData4f(gray, gray, gray, 1.0)
         if polygon.A.texcoord:
-            pal = (polygon.texture_palette + 1) * 256
+            pal = self.parent.texture.strip_offset(polygon.texture_palette)
 
             texcoord_A = uv_to_panda(polygon, pal, *polygon.A.texcoord.coords)
             texcoord_B = uv_to_panda(polygon, pal, *polygon.B.texcoord.coords)
@@ -299,21 +347,38 @@ class Polygon:
         node.addGeom(geom)
         self.node_path = self.parent.node_path_mesh.attachNewNode(node)
 
+    def show_highlight(self):
+        # Batched polygons have no node of their own; build one to draw the
+        # highlight over the batch while the polygon is hovered or selected.
+        if self.batched and self.node_path is None:
+            self.init_node_path()
+            self.node_path.setDepthOffset(1)
+
+    def hide_highlight(self):
+        if self.batched:
+            if self.node_path:
+                self.node_path.remove_node()
+                self.node_path = None
+            return False
+        return True
+
     def hover(self):
         self.is_hovered = True
         if not self.is_selected:
+            self.show_highlight()
             self.node_path.reparentTo(self.parent.node_path_ui)
             self.node_path.setColor(0.5, 0.5, 1.0, 1.0)
 
     def unhover(self):
         self.is_hovered = False
-        if not self.is_selected:
+        if not self.is_selected and self.hide_highlight():
             self.node_path.reparentTo(self.parent.node_path_mesh)
             self.node_path.setColor(*self.old_color)
 
     def select(self):
         self.unhover()
         self.is_selected = True
+        self.show_highlight()
         if not self.source.A.normal:
             self.node_path.reparentTo(self.parent.node_path_ui)
         self.node_path.setColor(0.0, 1.0, 0.0, 1.0)
@@ -339,9 +404,10 @@ class Polygon:
 
     def unselect(self):
         self.is_selected = False
-        if not self.source.A.normal:
-            self.node_path.reparentTo(self.parent.node_path_mesh)
-        self.node_path.setColor(*self.old_color)
+        if self.hide_highlight():
+            if not self.source.A.normal:
+                self.node_path.reparentTo(self.parent.node_path_mesh)
+            self.node_path.setColor(*self.old_color)
         del self.vA
         del self.vB
         del self.vC
@@ -355,10 +421,118 @@ class Polygon:
                 del self.nD
 
 
-class Palette:
-    def __init__(self, parent, data):
+class PolygonBatch:
+    """Every polygon of the map in two GeomNodes, textured and untextured.
+
+    Vertex data is built with NumPy straight from the PolygonTable columns,
+    then welded and cache-ordered by ganesha.mesh. Each vertex carries the
+    index of its polygon in World.polygons in a polygon_id column; welded
+    vertices keep the id of the first polygon using them, so the exact id
+    of every triangle is also kept in triangle_ids, and in the BVH pick()
+    casts rays against.
+    """
+
+    def __init__(self, parent, table):
         self.parent = parent
-        self.colors = data
+        self.node_paths = []
+        self.triangles = []
+        self.triangle_ids = []
+        self.triangle_corners = []
+        self.stats = {}
+        first_id = 0
+        batches = {True: [], False: []}
+        for group in table.groups:
+            batches[group.textured].append(self.group_vertices(group, first_id))
+            first_id += group.count
+        for (textured, name) in [(True, "textured"), (False, "untextured")]:
+            if not any(len(vertices) for vertices in batches[textured]):
+                continue
+            self.node_paths.append(self.init_node_path(name, batches[textured]))
+        if self.triangles:
+            self.triangles = np.concatenate(self.triangles)
+            self.triangle_ids = np.concatenate(self.triangle_ids)
+            self.triangle_corners = np.concatenate(self.triangle_corners)
+        self.picker = BVH(self.triangles, self.triangle_ids)
+
+    def __del__(self):
+        for node_path in self.node_paths:
+            node_path.remove_node()
+
+    def group_vertices(self, group, first_id):
+        vertices = np.zeros((group.count, group.corners), dtype=BATCH_VERTEX)
+        vertices["vertex"] = self.to_panda(group.xyz)
+        vertices["polygon_id"] = first_id + np.arange(group.count)[:, np.newaxis]
+        if group.textured:
+            vertices["normal"] = self.to_panda(group.normals)
+            vertices["color"] = (1.0, 1.0, 1.0, 1.0)
+            offsets = {
+                palette: self.parent.texture.strip_offset(palette)
+                for palette in np.unique(group.texture_palette).tolist()
+            }
+            pal = np.array([offsets[x] for x in group.texture_palette.tolist()])
+            page = group.texture_page[:, np.newaxis]
+            uv = group.texcoords
+            vertices["texcoord"][..., 0] = (uv[..., 0] + pal[:, np.newaxis]) / 256.0
+            vertices["texcoord"][..., 1] = 1.0 - (page + uv[..., 1] / 256.0) / 4.0
+        else:
+            vertices["color"] = (0.0, 0.0, 0.0, 1.0)
+        return vertices
+
+    def to_panda(self, coords):
+        return np.stack(coords_to_panda(*np.moveaxis(coords, -1, 0)), axis=-1)
+
+    def init_node_path(self, name, groups):
+        vertex_rows = []
+        index_rows = []
+        corner_rows = []
+        first_row = 0
+        for vertices in groups:
+            (count, corners) = vertices.shape
+            rows = first_row + corners * np.arange(count)[:, np.newaxis, np.newaxis]
+            indices = (rows + CORNER_TRIANGLES[corners]).reshape(-1, 3)
+            vertex_rows.append(vertices.reshape(-1))
+            index_rows.append(indices)
+            corner_rows.append(np.tile(CORNER_TRIANGLES[corners], (count, 1)))
+            first_row += vertices.size
+        vertices = np.concatenate(vertex_rows)
+        indices = np.concatenate(index_rows)
+        triangle_ids = vertices["polygon_id"][indices[:, 0]]
+        (vertices, indices, order, self.stats[name]) = mesh.optimize(
+            vertices, indices, WELD_KEY_SIZE
+        )
+        self.triangles.append(vertices["vertex"][indices].astype(np.float64))
+        self.triangle_ids.append(triangle_ids[order])
+        self.triangle_corners.append(np.concatenate(corner_rows)[order])
+
+        vdata = GeomVertexData(name, BATCH_FORMAT, Geom.UHStatic)
+        vdata.uncleanSetNumRows(len(vertices))
+        copy_into(vdata.modifyArray(0), vertices)
+        primitive = GeomTriangles(Geom.UHStatic)
+        primitive.setIndexType(Geom.NT_uint32)
+        index = primitive.modifyVertices()
+        index.uncleanSetNumRows(indices.size)
+        copy_into(index, indices.astype("<u4"))
+        geom = Geom(vdata)
+        geom.addPrimitive(primitive)
+        node = GeomNode(name)
+        node.addGeom(geom)
+        return self.parent.node_path_mesh.attachNewNode(node)
+
+    def pick(self, origin, direction):
+        """The nearest picking.Hit along a ray in mesh coordinates, or None.
+        Like Panda's collision rays, both faces are hit."""
+        return self.picker.intersect(origin, direction)
+
+    def refit(self, polygon_ids):
+        """Re-read the corners of edited polygons into the picker."""
+        rows = np.flatnonzero(np.isin(self.triangle_ids, polygon_ids))
+        triangles = []
+        for row in rows.tolist():
+            source = self.parent.polygons[self.triangle_ids[row]].source
+            corners = self.to_panda(source.group.xyz[source.index])
+            triangles.append(corners[self.triangle_corners[row]])
+        if triangles:
+            self.picker.refit(rows, np.array(triangles, dtype=np.float64))
 
 
 class Ambient_Light:
@@ -486,8 +660,33 @@ class Background:
         self.node_path = self.parent.parent.base.camera.attachNewNode(node)
 
 
+def tile_field(name):
+    """Property reading and writing one field of the terrain array."""
+
+    def get(self):
+        return int(self.parent.data.tiles[name][self.y, self.z, self.x])
+
+    def set(self, value):
+        self.parent.data.tiles[name][self.y, self.z, self.x] = value
+
+    return property(get, set)
+
+
 class Tile:
-    def __init__(self, parent, x, y, z, tile_data):
+    unknown1 = tile_field("unknown1")
+    surface_type = tile_field("surface_type")
+    unknown2 = tile_field("unknown2")
+    height = tile_field("height")
+    depth = tile_field("depth")
+    slope_height = tile_field("slope_height")
+    slope_type = tile_field("slope_type")
+    unknown3 = tile_field("unknown3")
+    unknown4 = tile_field("unknown4")
+    cant_walk = tile_field("cant_walk")
+    cant_cursor = tile_field("cant_cursor")
+    unknown5 = tile_field("unknown5")
+
+    def __init__(self, parent, x, y, z):
         self.parent = parent
         self.format = GeomVertexFormat.getV3c4()
         self.node_path = None
@@ -499,18 +698,6 @@ class Tile:
         self.y = y
         self.z = z
         self.coords = (x, z)
-        self.unknown1 = tile_data.unknown1
-        self.surface_type = tile_data.surface_type
-        self.unknown2 = tile_data.unknown2
-        self.height = tile_data.height
-        self.depth = tile_data.depth
-        self.slope_height = tile_data.slope_height
-        self.slope_type = tile_data.slope_type
-        self.unknown3 = tile_data.unknown3
-        self.unknown4 = tile_data.unknown4
-        self.cant_walk = tile_data.cant_walk
-        self.cant_cursor = tile_data.cant_cursor
-        self.unknown5 = tile_data.unknown5
 
     def __del__(self):
         self.node_path.remove_node()
@@ -524,19 +711,11 @@ class Tile:
         primitive = GeomTristrips(Geom.UHStatic)
         # Defined but currently unused
         # y = self.height * 12 + self.depth * 12 + 1
-        try:
-            (slope, rotation) = slope_types[self.slope_type]
-        except KeyError:
+        if self.slope_type not in slope_types:
             print("Unknown slope type:", self.slope_type)
-            (slope, rotation) = (flat, 0)
-        if self.slope_height == 0:
-            (slope, rotation) = (flat, 0)
-        scale_y = self.slope_height * 12
-        vertex.addData3f(*coords_to_panda(-14.0, -slope["sw"] * scale_y, -14.0))
-        vertex.addData3f(*coords_to_panda(-14.0, -slope["nw"] * scale_y, 14.0))
-        vertex.addData3f(*coords_to_panda(14.0, -slope["ne"] * scale_y, 14.0))
-        vertex.addData3f(*coords_to_panda(14.0, -slope["se"] * scale_y, -14.0))
-        vertex.addData3f(*coords_to_panda(-14.0, -slope["sw"] * scale_y, -14.0))
+        (corners, rotation) = self.corners()
+        for corner in corners:
+            vertex.addData3f(*corner)
         tile_color = (0.5, 0.5, 1.0)
         if self.cant_walk:
             tile_color = (1.0, 0.5, 0.5)
@@ -558,17 +737,44 @@ class Tile:
         node.addGeom(geom)
         self.node_path = self.parent.node_path.attachNewNode(node)
         self.node_path.setH(rotation)
+        self.node_path.setPos(*self.position())
+        self.parent.triangles[self.y, self.z, self.x] = self.triangles()
+
+    def corners(self):
+        """The tile's strip of corners (sw, nw, ne, se, sw) before rotation,
+        and its rotation."""
+        (slope, rotation) = slope_types.get(self.slope_type, (flat, 0))
+        if self.slope_height == 0:
+            (slope, rotation) = (flat, 0)
+        scale_y = self.slope_height * 12
+        corners = [
+            coords_to_panda(-14.0, -slope["sw"] * scale_y, -14.0),
+            coords_to_panda(-14.0, -slope["nw"] * scale_y, 14.0),
+            coords_to_panda(14.0, -slope["ne"] * scale_y, 14.0),
+            coords_to_panda(14.0, -slope["se"] * scale_y, -14.0),
+            coords_to_panda(-14.0, -slope["sw"] * scale_y, -14.0),
+        ]
+        return (corners, rotation)
+
+    def position(self):
         can_stand_height = 0
         if not self.cant_cursor:
             can_stand_height = 1
-        self.node_path.setPos(
-            *coords_to_panda(
-                self.x * 28 + 14,
-                -((self.height + self.depth) * 12 + 1 + can_stand_height),
-                self.z * 28 + 14,
-            )
+        return coords_to_panda(
+            self.x * 28 + 14,
+            -((self.height + self.depth) * 12 + 1 + can_stand_height),
+            self.z * 28 + 14,
+        )
+
+    def triangles(self):
+        """The three triangles of the tile's strip, in terrain coordinates."""
+        (corners, rotation) = self.corners()
+        angle = pi * rotation / 180
+        rotate = np.array(
+            [[cos(angle), -sin(angle), 0.0], [sin(angle), cos(angle), 0.0], [0, 0, 1]]
         )
-        self.node_path.setTag("terrain_xyz", "%u,%u,%u" % (self.x, self.y, self.z))
+        points = np.array(corners) @ rotate.T + self.position()
+        return points[[[0, 1, 2], [1, 2, 3], [2, 3, 4]]]
 
     def hover(self):
         self.is_hovered = True
@@ -595,17 +801,15 @@ class Terrain:
         self.parent = parent
         self.node_path = None
 
-        self.tiles = []
-        y = 0
-        for level_data in terrain_data.tiles:
-            level = []
-            for z, row_data in enumerate(level_data):
-                row = []
-                for x, tile_data in enumerate(row_data):
-                    row.append(Tile(self, x, y, z, tile_data))
-                level.append(row)
-            self.tiles.append(level)
-            y += 1
+        self.data = terrain_data
+        (levels, z_count, x_count) = terrain_data.tiles.shape
+        # Every tile's surface triangles, kept current by Tile.init_node_path.
+        self.triangles = np.zeros((levels, z_count, x_count, 3, 3, 3))
+        self.picker = GridPicker(self.triangles, 28)
+        self.tiles = [
+            [[Tile(self, x, y, z) for x in range(x_count)] for z in range(z_count)]
+            for y in range(levels)
+        ]
 
         self.init_node_path()
 
@@ -622,75 +826,193 @@ class Terrain:
                 for tile in row:
                     tile.init_node_path()
 
+    def pick(self, origin, direction):
+        """(x, y, z) of the tile under a ray in terrain coordinates, or None."""
+        hit = self.picker.intersect(origin, direction)
+        if hit is None:
+            return None
+        (y, z, x) = hit
+        return (x, y, z)
 
-class Texture:
-    def __init__(self, texture_data, palettes):
-        self.texture = None
-        self.texture2 = None
-
-        tex_pnm = PNMImage(17 * 256, 1024)
-        tex_pnm.addAlpha()
-
-        testpnm = PNMImage(256, 1024)
-
-        palette = [(x, x, x, 1) for x in range(16)]
-        colors = []
-        for color in palette:
-            color_list = [c / 15.0 for c in color[:3]]
-            color_list.append(0 if color == (0, 0, 0, 0) else 1)
-            colors.append(VBase4F(*color_list))
 
-        for y in range(1024):
-            row = texture_data.image[y]
-            for x in range(256):
-                testpnm.setXelA(x, y, colors[row[x]])
+def palette_to_bgra(colors):
+    """Convert (..., r, g, b[, a]) palette colors to the atlas' BGRA bytes."""
+    rgb = np.asarray(colors, dtype=float)[..., :3]
+    bgra = np.empty(rgb.shape[:-1] + (4,), dtype=np.uint8)
+    bgra[..., 2::-1] = np.clip(rgb / 15.0, 0.0, 1.0) * 255 + 0.5
+    bgra[..., 3] = 255
+    return bgra
 
-        self.texture2 = P3DTexture()
-        self.texture2.load(testpnm)
-        self.texture2.setMagfilter(P3DTexture.FTNearest)
-        self.texture2.setMinfilter(P3DTexture.FTLinear)
 
-        self.update(tex_pnm, texture_data, palettes)
+def load_ram_image(texture, image):
+    """Set up a Panda texture whose RAM image is a top-down BGRA array."""
+    (height, width) = image.shape[:2]
+    texture.setup2dTexture(width, height, P3DTexture.T_unsigned_byte, P3DTexture.F_rgba)
+    # Panda stores RAM images bottom row first
+    texture.setRamImage(np.ascontiguousarray(image[::-1]))
+    texture.setMagfilter(P3DTexture.FTNearest)
+    texture.setMinfilter(P3DTexture.FTLinear)
+    return texture
 
-    def update(self, pnm, texture_data, palettes):
 
-        self.palettes = []
-        temp = []
-        for x in range(16):
-            temp.append((x, x, x, 1))
+class Texture:
+    """Palette atlas holding one 256-texel strip per palette in use.
 
-        self.palettes.append(temp)
+    Strip 0 is always grayscale. Color palettes get a strip the first time
+    strip_offset asks for them, so maps that only use a few palettes only
+    pay for those.
+    """
 
-        for y, palette in enumerate(palettes):
-            selfpalette = []
-            for x, color in enumerate(palette.colors.colors):
-                selfpalette.append((color[0], color[1], color[2], 1))
-            self.palettes.append(selfpalette)
+    def __init__(self, texture_data, palettes, used_palettes=()):
+        self.texture = P3DTexture()
+        self.texture2 = None
+        self.texture_data = texture_data
+        self.image = None
+        self.lut = None
+        self.slots = [None] + sorted(used_palettes)
+        self.node_paths = []
+        self.update(texture_data, palettes)
+        self.texture2 = load_ram_image(P3DTexture(), self.lut[0][texture_data.image])
+
+    def update(self, texture_data, palettes):
+        # One row per palette: grayscale first, then the 16 color palettes.
+        self.lut = np.empty((17, 16, 4), dtype=np.uint8)
+        self.lut[0] = palette_to_bgra([(x, x, x) for x in range(16)])
+        self.lut[1:] = palette_to_bgra(palettes.colors)
+        self.texture_data = texture_data
+        # Animations draw into this copy, never into the map's own texture.
+        self.image = texture_data.image.copy()
+        self.build()
+
+    def build(self):
+        rows = [self.lut_row(palette) for palette in self.slots]
+        strips = self.lut[rows][:, self.image]
+        atlas = strips.transpose(1, 0, 2, 3).reshape(1024, len(rows) * 256, 4)
+        load_ram_image(self.texture, atlas)
+        for node_path in self.node_paths:
+            self.set_tex_scale(node_path)
+
+    def lut_row(self, palette):
+        return 0 if palette is None else palette + 1
+
+    def set_palette(self, palette, colors):
+        """Replace one color palette, rewriting only its strip in place.
+
+        The Panda texture object, its size and every texcoord stay as they
+        are, so nothing bound to the texture has to be rebuilt.
+        """
+        self.lut[palette + 1] = palette_to_bgra(colors)
+        if palette in self.slots:
+            self.write_strip(self.slots.index(palette))
+
+    def modify_ram_image(self):
+        """Writable top-down BGRA view of the atlas' RAM image."""
+        ram = np.frombuffer(memoryview(self.texture.modifyRamImage()), np.uint8)
+        return ram.reshape(1024, len(self.slots) * 256, 4)[::-1]
+
+    def write_strip(self, slot):
+        ram = self.modify_ram_image()
+        image = self.lut[self.lut_row(self.slots[slot])][self.image]
+        ram[:, slot * 256 : (slot + 1) * 256] = image
+
+    def copy_region(self, source, dest, size):
+        """Copy a texel region of the original texture over another one.
+
+        Only the destination rectangle is regathered, in every strip.
+        """
+        (x, y) = dest
+        (width, height) = size
+        (src_x, src_y) = source
+        width = min(width, 256 - x, 256 - src_x)
+        height = min(height, 1024 - y, 1024 - src_y)
+        if min(x, y, src_x, src_y) < 0 or width <= 0 or height <= 0:
+            return
+        region = self.texture_data.image[src_y : src_y + height, src_x : src_x + width]
+        self.image[y : y + height, x : x + width] = region
+        ram = self.modify_ram_image()
+        for slot, palette in enumerate(self.slots):
+            colors = self.lut[self.lut_row(palette)]
+            left = slot * 256 + x
+            ram[y : y + height, left : left + width] = colors[region]
+
+    def apply(self, node_path):
+        node_path.setTexture(self.texture)
+        self.set_tex_scale(node_path)
+        self.node_paths.append(node_path)
+
+    def set_tex_scale(self, node_path):
+        # Texcoords are measured in strips; scale them onto the atlas width.
+        node_path.setTexScale(TextureStage.getDefault(), 1.0 / len(self.slots), 1.0)
+
+    def strip_offset(self, palette):
+        if palette not in self.slots:
+            self.slots.append(palette)
+            self.build()
+        return self.slots.index(palette) * 256
+
+
+class Animation:
+    """Plays texture and palette animations as a Panda task.
+
+    Each frame change only rewrites the affected region or palette strip of
+    the atlas' RAM image; the texture is never rebuilt.
+    """
+
+    # The game advances animations at 30 ticks per second.
+    tick_rate = 30
+
+    def __init__(self, parent, texture_anims, palette_frames):
+        self.parent = parent
+        self.texture_anims = texture_anims
+        self.palette_frames = palette_frames
+        self.frames = [None] * len(texture_anims)
+        self.task = None
 
-        i = 0
-        for palette in self.palettes:
-            colors = []
-            for color in palette:
-                color_list = [c / 15.0 for c in color[:3]]
-                color_list.append(0 if color == (0, 0, 0, 0) else 1)
-                colors.append(VBase4F(*color_list))
+    def __del__(self):
+        self.stop()
 
-            for y in range(1024):
-                row = texture_data.image[y]
-                for x in range(256):
-                    pnm.setXelA(x + (256 * i), y, colors[row[x]])
-            i += 1
+    def start(self):
+        if self.texture_anims and self.task is None:
+            self.task = self.parent.parent.base.taskMgr.add(
+                self.animate, "texture_animation"
+            )
 
-        self.texture = P3DTexture()
-        self.texture.load(pnm)
-        self.texture.setMagfilter(P3DTexture.FTNearest)
-        self.texture.setMinfilter(P3DTexture.FTLinear)
+    def stop(self):
+        if self.task is not None:
+            self.parent.parent.base.taskMgr.remove(self.task)
+            self.task = None
+
+    def animate(self, task):
+        tick = int(task.time * self.tick_rate)
+        texture = self.parent.texture
+        for i, animation in enumerate(self.texture_anims):
+            frame = animation.frame_at(tick)
+            if frame == self.frames[i]:
+                continue
+            self.frames[i] = frame
+            if animation.is_palette:
+                if self.palette_frames is None or not len(self.palette_frames):
+                    continue
+                n = (animation.first_frame + frame) % len(self.palette_frames)
+                texture.set_palette(animation.palette, self.palette_frames[n])
+            else:
+                texture.copy_region(
+                    animation.frame_source(frame), animation.canvas, animation.size
+                )
+        return task.cont
 
 
 class World:
-    def __init__(self, parent):
+    def __init__(self, parent, batched=True):
         self.parent = parent
-        self.map = fftmap.Map()
+        # Draw the mesh as one PolygonBatch instead of a node per polygon.
+        self.batched = batched
+        self.batch = None
+        # GNS the batch's mesh stats were last printed for.
+        self.stats_gns = None
+        # Bumped whenever what the mouse could be over changes.
+        self.generation = 0
+        self.map = fftmap.Map(MapCache(), SituationCache())
         self.node_path = None
         self.textures = []
         self.polygons = None
@@ -704,12 +1026,18 @@ class World:
         self.gray_palettes = None
         self.polygon_anim = None
         self.animated_polygons = None
+        self.animation = None
+        self.catalog = None
         self.center_x = 0
         self.center_y = 0
         self.center_z = 0
         self.init_camera()
 
+    def touch(self):
+        self.generation += 1
+
     def read(self):
+        self.touch()
         self.node_path = self.parent.base.render.attachNewNode("world")
         self.node_path.setTransparency(TransparencyAttrib.MAlpha)
         self.node_path_mesh = self.node_path.attachNewNode("mesh")
@@ -726,6 +1054,7 @@ class World:
         self.get_background()
         self.get_terrain()
         self.get_gray_palettes()
+        self.get_animations()
         self.full_light = Ambient_Light(self, (255, 255, 255))
         self.set_center()
 
@@ -804,23 +1133,57 @@ class World:
             self.node_path_mesh.clearLight(self.full_light.node_path)
 
     def get_texture(self):
-        self.texture = Texture(self.map.get_texture(), self.color_palettes)
-        self.node_path_mesh.setTexture(self.texture.texture)
+        self.texture = Texture(
+            self.map.get_texture(),
+            self.color_palettes,
+            self.map.get_polygon_table().palettes_used(),
+        )
+        self.texture.apply(self.node_path_mesh)
 
     def get_polygons(self):
         polygons = []
         reset_polygon_id()
         for i, poly_data in enumerate(self.map.get_polygons()):
-            polygon = Polygon(self, poly_data)
+            polygon = Polygon(self, poly_data, self.batched)
             polygon_id = next_polygon_id()
-            polygon.node_path.setTag("polygon_i", str(polygon_id))
+            if not self.batched:
+                polygon.node_path.setTag("polygon_i", str(polygon_id))
             polygons.append(polygon)
         self.polygons = polygons
+        if self.batched:
+            self.batch = PolygonBatch(self, self.map.get_polygon_table())
+            if self.stats_gns is self.map.gns:
+                return
+            self.stats_gns = self.map.gns
+            for (name, stats) in self.batch.stats.items():
+                print(
+                    "Mesh {}: {} -> {} vertices, {} -> {} indices, "
+                    "ACMR {:.2f} -> {:.2f}".format(
+                        name, *stats["vertices"] + stats["indices"] + stats["acmr"]
+                    )
+                )
+
+    def pick_polygon(self, origin, direction):
+        """The Polygon under a ray given in mesh coordinates, or None."""
+        hit = self.batch.pick(origin, direction)
+        if hit is None:
+            return None
+        return self.polygons[hit.polygon_id]
+
+    def pick_tile(self, origin, direction):
+        """The Tile under a ray given in terrain coordinates, or None."""
+        hit = self.terrain.pick(origin, direction)
+        if hit is None:
+            return None
+        (x, y, z) = hit
+        return self.terrain.tiles[y][z][x]
+
+    def set_palette(self, palette, colors):
+        self.color_palettes.colors[palette] = colors
+        self.texture.set_palette(palette, colors)
 
     def get_color_palettes(self):
-        self.color_palettes = [
-            Palette(self, data) for data in self.map.get_color_palettes()
-        ]
+        self.color_palettes = self.map.get_color_palettes()
 
     def get_dir_lights(self):
         dir_lights = []
@@ -847,38 +1210,72 @@ class World:
         self.terrain = terrain
 
     def get_gray_palettes(self):
-        palettes = []
-        for palette_data in self.map.get_gray_palettes():
-            palette = Palette(self, palette_data)
-            palettes.append(palette)
-        self.gray_palettes = palettes
+        self.gray_palettes = self.map.get_gray_palettes()
+
+    def get_animations(self):
+        if self.animation:
+            self.animation.stop()
+        self.texture_anim = self.map.get_texture_anims()
+        self.palette_anim = self.map.get_palette_anims()
+        self.polygon_anim = self.map.get_mesh_anims()
+        self.animated_polygons = self.map.get_animated_meshes()
+        self.animation = Animation(self, self.texture_anim, self.palette_anim)
+        self.animation.start()
+
+    def save(self):
+        try:
+            written = self.map.write(
+                self.terrain.data, self.color_palettes, self.gray_palettes
+            )
+        except (OSError, KeyError, ValueError) as error:
+            print(time.strftime("%H:%M:%S"), "Unable to save map:", error)
+            return
+        print(time.strftime("%H:%M:%S"), "Saved map,", written, "bytes written")
+        if self.catalog is not None:
+            # Re-hash the files just written.
+            self.catalog = MapCatalog(self.catalog.map_dir).start()
 
     def read_gns(self, gns_path):
         if gns_path is None:
             gns_path = self.parent.file_dialog()
         assert gns_path is not None, "No GNS file chosen. Exiting."
-        self.map.gns = fftmap.GNS()
-        self.map.gns.read(gns_path)
+        gns = fftmap.GNS()
+        disc_path = split_disc_path(gns_path)
+        if disc_path is None:
+            gns.read(gns_path)
+        else:
+            (image_path, file_path) = disc_path
+            gns.read_disc(open_disc(image_path), file_path)
+        resource_pool.clear()
+        self.map.set_gns(gns)
         self.map.set_situation(0)
 
+    def next_disc_gns(self):
+        (image_path, file_path) = split_disc_path(self.map.gns.file_path)
+        (gns_dir, gns_name) = os.path.split(file_path)
+        files = sorted(
+            x for x in self.map.gns.disc.listdir(gns_dir) if x[-4:] == ".GNS"
+        )
+        gns_name = gns_name.upper()
+        if gns_name not in files:
+            return
+        new_file_name = files[(files.index(gns_name) + 1) % len(files)]
+        self.read_gns("{}:{}".format(image_path, os.path.join(gns_dir, new_file_name)))
+        self.read()
+
     def next_gns(self):
+        if self.map.gns.disc is not None:
+            self.next_disc_gns()
+            return
         gns_path = self.map.gns.file_path
-        gns_dir = os.path.dirname(gns_path)
-        gns_name = os.path.basename(gns_path)
-        files = []
-        for file_name in os.listdir(gns_dir):
-            if file_name[-4:] in [".gns", ".GNS"]:
-                files.append(file_name)
-        files.sort()
-        found = False
-        for i, file_name in enumerate(files):
-            if file_name == gns_name:
-                found = True
-                break
-        if found:
-            new_i = (i + 1) % len(files)
-            new_file_name = files[new_i]
-            new_gns_path = os.path.join(gns_dir, new_file_name)
+        gns_dir = os.path.dirname(os.path.abspath(gns_path))
+        if self.catalog is None or self.catalog.map_dir != gns_dir:
+            self.catalog = MapCatalog(gns_dir).start()
+        if self.catalog.ready.is_set():
+            new_gns_path = self.catalog.next_map(gns_path)
+        else:
+            new_gns_path = next_listed_map(gns_path)
+        if new_gns_path is not None:
             self.read_gns(new_gns_path)
             self.read()
 
@@ -0,0 +1,162 @@
+"""Write edited chunks back to resource files.
+
+ResourceWriter keeps one file in a preallocated buffer and records which
+byte ranges changed. Chunks that keep their size are patched in place with
+pack_into, and only their changed runs are marked dirty. A chunk that
+changes size is spliced in and the TOC offsets after it are shifted.
+
+A save writes a temporary file and renames it over the target, so a
+crash or a full disk mid-save leaves the original untouched. When no chunk
+changed size, the temporary file is a copy of the original with just the
+dirty ranges written into it; otherwise it gets the whole buffer.
+"""
+
+import os
+import shutil
+from struct import calcsize, pack_into, unpack_from
+
+import numpy as np
+
+from ganesha.disc import DiscFile
+from ganesha.resource import Resources, chunk_bounds
+
+# Changed bytes closer together than this are written as one range.
+MERGE_GAP = 16
+
+
+def changed_runs(old, new):
+    """(begin, end) runs where two equal-length buffers differ."""
+    old = np.frombuffer(old, dtype=np.uint8)
+    new = np.frombuffer(new, dtype=np.uint8)
+    changed = np.flatnonzero(old != new)
+    if not len(changed):
+        return []
+    breaks = np.flatnonzero(np.diff(changed) > MERGE_GAP)
+    begins = np.concatenate([changed[:1], changed[breaks + 1]])
+    ends = np.concatenate([changed[breaks], changed[-1:]]) + 1
+    return list(zip(begins.tolist(), ends.tolist()))
+
+
+class ResourceWriter:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, "rb") as file:
+            self.buffer = bytearray(file.read())
+        self.toc = list(unpack_from("<49I", self.buffer))
+        self.bounds = chunk_bounds(self.toc, len(self.buffer))
+        self.dirty = []
+        self.resized = False
+
+    def chunk(self, toc_offset):
+        (begin, end) = self.bounds[toc_offset // 4]
+        return memoryview(self.buffer)[begin:end]
+
+    def mark(self, begin, end):
+        self.dirty.append((begin, end))
+
+    def pack(self, toc_offset, offset, fmt, *values):
+        """Patch a single field inside a chunk."""
+        (begin, end) = self.bounds[toc_offset // 4]
+        if offset < 0 or offset + calcsize(fmt) > end - begin:
+            raise ValueError("Write outside chunk 0x{:02X}".format(toc_offset))
+        pack_into(fmt, self.buffer, begin + offset, *values)
+        self.mark(begin + offset, begin + offset + calcsize(fmt))
+
+    def set_chunk(self, toc_offset, data):
+        (begin, end) = self.bounds[toc_offset // 4]
+        if len(data) == end - begin:
+            for (run_begin, run_end) in changed_runs(self.chunk(toc_offset), data):
+                fmt = "{}s".format(run_end - run_begin)
+                run = bytes(data[run_begin:run_end])
+                pack_into(fmt, self.buffer, begin + run_begin, run)
+                self.mark(begin + run_begin, begin + run_end)
+            return
+        delta = len(data) - (end - begin)
+        self.buffer[begin:end] = data
+        for (i, offset) in enumerate(self.toc):
+            if offset and offset >= end and i != toc_offset // 4:
+                self.toc[i] = offset + delta
+        pack_into("<49I", self.buffer, 0, *self.toc)
+        self.bounds = chunk_bounds(self.toc, len(self.buffer))
+        self.resized = True
+
+    def dirty_ranges(self):
+        ranges = []
+        for (begin, end) in sorted(self.dirty):
+            if ranges and begin <= ranges[-1][1] + MERGE_GAP:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((begin, end))
+        return ranges
+
+    def save(self, file_path=None):
+        """Atomically write the file; returns how many bytes changed."""
+        file_path = file_path or self.file_path
+        if not self.resized and not self.dirty and file_path == self.file_path:
+            return 0
+        if self.resized or file_path != self.file_path:
+            written = len(self.buffer)
+        else:
+            written = sum(end - begin for (begin, end) in self.dirty_ranges())
+        self.replace(file_path)
+        self.file_path = file_path
+        self.dirty = []
+        self.resized = False
+        return written
+
+    def replace(self, file_path):
+        """Write the buffer to a temporary file and rename it over
+        `file_path`."""
+        temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        try:
+            if self.resized or file_path != self.file_path:
+                with open(temp_path, "wb") as file:
+                    file.write(self.buffer)
+                    file.flush()
+                    os.fsync(file.fileno())
+            else:
+                shutil.copyfile(self.file_path, temp_path)
+                with open(temp_path, "r+b") as file:
+                    for (begin, end) in self.dirty_ranges():
+                        file.seek(begin)
+                        file.write(self.buffer[begin:end])
+                    file.flush()
+                    os.fsync(file.fileno())
+            shutil.copymode(self.file_path, temp_path)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class MapWriter:
+    """Routes chunk writes to the file each chunk of a map was read from.
+
+    Ownership is worked out from the files' TOCs, the same way Resources
+    resolves the fallback chain.
+    """
+
+    def __init__(self, resource_files):
+        self.resources = Resources(pool=None)
+        self.resources.read(resource_files)
+        self.writers = {}
+
+    def writer(self, toc_offset):
+        resource = self.resources.chunks[toc_offset // 4]
+        if resource is None:
+            raise KeyError("Map has no chunk 0x{:02X}".format(toc_offset))
+        if isinstance(resource.file_path, DiscFile):
+            raise IOError("Maps inside a disc image can not be saved")
+        if resource.file_path not in self.writers:
+            self.writers[resource.file_path] = ResourceWriter(resource.file_path)
+        return self.writers[resource.file_path]
+
+    def set_chunk(self, toc_offset, data):
+        self.writer(toc_offset).set_chunk(toc_offset, data)
+
+    def pack(self, toc_offset, offset, fmt, *values):
+        self.writer(toc_offset).pack(toc_offset, offset, fmt, *values)
+
+    def save(self):
+        return sum(writer.save() for writer in self.writers.values())
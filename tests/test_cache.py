@@ -0,0 +1,169 @@
+import copy
+import json
+import os
+import threading
+from struct import unpack
+
+import pytest
+
+from ganesha import fftmap
+from ganesha.cache import MapCache, SituationCache, warm
+from ganesha.gns import RECORD, RESOURCE_TYPE0
+from tests.util import random_bytes, write_resource_file
+
+CHUNKS = {
+    0x40: random_bytes(300, 1),
+    0x44: random_bytes(512, 2),
+    0x68: random_bytes(100, 3),
+}
+
+
+@pytest.fixture
+def files(tmp_path):
+    texture_path = tmp_path / "MAP001.8"
+    texture_path.write_bytes(random_bytes(1024 * 128, 4))
+    resource_path = write_resource_file(tmp_path / "MAP001.9", CHUNKS)
+    return ([str(texture_path)], [resource_path])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MapCache(str(tmp_path / "cache"), background=False)
+
+
+def new_map(cache, files):
+    fft_map = fftmap.Map(cache)
+    (fft_map.texture_files, fft_map.resource_files) = files
+    return fft_map
+
+
+def sidecar_path(cache, files):
+    return cache.cache_path(*files)
+
+
+def contents(fft_map):
+    chunks = {
+        i * 4: bytes(fft_map.resources.get_chunk(i * 4))
+        for i in range(49)
+        if fft_map.resources.has_chunk(i * 4)
+    }
+    return (fft_map.get_texture().indices.tobytes(), chunks)
+
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+
+def test_miss_then_hit(cache, files):
+    fft_map = new_map(cache, files)
+    assert not cache.load(fft_map)
+    fft_map.read()
+    assert os.path.exists(sidecar_path(cache, files))
+    cached = new_map(cache, files)
+    assert cache.load(cached)
+    assert contents(cached) == contents(fft_map)
+    assert cached.texture_indices.shape == (1024, 256)
+
+
+def test_changed_source_is_a_miss(cache, files):
+    new_map(cache, files).read()
+    resource_path = files[1][0]
+    data = bytearray(open(resource_path, "rb").read())
+    data[-1] ^= 0xFF
+    with open(resource_path, "wb") as file:
+        file.write(data)
+    bump_mtime(resource_path)
+    assert not cache.load(new_map(cache, files))
+    fft_map = new_map(cache, files)
+    fft_map.read()
+    cached = new_map(cache, files)
+    assert cache.load(cached)
+    assert bytes(cached.resources.get_chunk(0x68))[-1] == data[-1]
+
+
+def test_touched_source_is_still_a_hit(cache, files):
+    new_map(cache, files).read()
+    bump_mtime(files[0][0])
+    assert cache.load(new_map(cache, files))
+    # The new mtime is recorded, so the next load needs no re-hash.
+    data = open(sidecar_path(cache, files), "rb").read()
+    (_, header_size) = unpack("<II", data[8:16])
+    sources = json.loads(data[16 : 16 + header_size])["sources"]
+    assert sources[0]["mtime"] == os.stat(files[0][0]).st_mtime_ns
+    assert cache.load(new_map(cache, files))
+
+
+@pytest.mark.parametrize("cut", [4, 12, 20, 200, -1000])
+def test_truncated_sidecar_is_a_miss(cache, files, cut):
+    new_map(cache, files).read()
+    path = sidecar_path(cache, files)
+    data = open(path, "rb").read()
+    with open(path, "wb") as file:
+        file.write(data[:cut])
+    assert not cache.load(new_map(cache, files))
+
+
+def test_corrupt_header_is_a_miss(cache, files):
+    new_map(cache, files).read()
+    path = sidecar_path(cache, files)
+    data = bytearray(open(path, "rb").read())
+    data[16:24] = b"{garbage"
+    with open(path, "wb") as file:
+        file.write(data)
+    assert not cache.load(new_map(cache, files))
+
+
+def test_background_fill(tmp_path, files):
+    cache = MapCache(str(tmp_path / "cache"))
+    fft_map = new_map(cache, files)
+    fft_map.read()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    assert cache.load(new_map(cache, files))
+
+
+def test_store_drops_entries_of_changed_sources(cache, files):
+    fft_map = new_map(cache, files)
+    fft_map.texture.read(fft_map.texture_files)
+    fft_map.resources.read(fft_map.resource_files)
+    stats = cache.file_stats(fft_map)
+    bump_mtime(files[1][0])
+    assert not cache.store(copy.copy(fft_map), None, stats)
+    assert not os.path.exists(sidecar_path(cache, files))
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_disc_files_are_not_cached(cache, files):
+    fft_map = new_map(cache, files)
+    fft_map.resource_files = [object()]
+    assert not cache.cacheable(fft_map)
+    assert not cache.load(fft_map)
+
+
+def test_situation_cache_budget():
+    situations = SituationCache(budget=100)
+    situations.put("a", "A", 60)
+    situations.put("b", "B", 30)
+    assert situations.get("a") == "A"
+    situations.put("c", "C", 30)
+    assert situations.get("b") is None
+    assert (len(situations), situations.size) == (2, 90)
+    situations.put("d", "D", 500)
+    assert (situations.get("d"), len(situations)) == ("D", 1)
+
+
+def test_warm_skips_unknown_maps(tmp_path, cache, capsys):
+    map_dir = tmp_path / "maps"
+    map_dir.mkdir()
+    record = RECORD.pack(0x22, 0, 0, RESOURCE_TYPE0, 0, 0)
+    (map_dir / "MAP999.GNS").write_bytes(record)
+    (map_dir / "MAPXYZ.GNS").write_bytes(record)
+    (map_dir / "notes.txt").write_bytes(b"")
+    warm(str(map_dir), cache)
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[:3] for line in lines] == [
+        ["Unable", "to", "cache"],
+        ["Unable", "to", "cache"],
+    ]
@@ -0,0 +1,187 @@
+import os
+import random
+from struct import pack
+
+import pytest
+
+from ganesha.disc import (
+    RAW_SECTOR_SIZE,
+    SECTOR_SIZE,
+    SYNC,
+    DiscImage,
+    open_disc,
+    split_disc_path,
+)
+from ganesha.gns import GNS, RECORD, RESOURCE_EOF, RESOURCE_TEXTURE, RESOURCE_TYPE0
+
+ROOT_LBA = 18
+MAP_DIR_LBA = 19
+FIRST_FILE_LBA = 20
+
+
+def directory_record(name, lba, size, is_dir):
+    name = name.encode("ascii")
+    length = 33 + len(name) + (33 + len(name)) % 2
+    record = bytearray(length)
+    record[0] = length
+    record[2:10] = pack("<I", lba) + pack(">I", lba)
+    record[10:18] = pack("<I", size) + pack(">I", size)
+    record[25] = 0x02 if is_dir else 0x00
+    record[32] = len(name)
+    record[33 : 33 + len(name)] = name
+    return bytes(record)
+
+
+def dot_records(lba, parent_lba):
+    return directory_record("\x00", lba, SECTOR_SIZE, True) + directory_record(
+        "\x01", parent_lba, SECTOR_SIZE, True
+    )
+
+
+def file_layout(files):
+    """(lba, size) of every file, in the order iso_image places them, and
+    the sector count of the whole image."""
+    lba = FIRST_FILE_LBA
+    layout = {}
+    for (name, data) in files.items():
+        layout[name] = (lba, len(data))
+        lba += max(1, (len(data) + SECTOR_SIZE - 1) // SECTOR_SIZE)
+    return (layout, lba)
+
+
+def iso_image(files):
+    """A 2048-byte-sector ISO 9660 image with `files` in a MAP directory."""
+    (layout, sector_count) = file_layout(files)
+    image = bytearray(sector_count * SECTOR_SIZE)
+
+    def put(lba, data):
+        image[lba * SECTOR_SIZE : lba * SECTOR_SIZE + len(data)] = data
+
+    pvd = bytearray(SECTOR_SIZE)
+    pvd[0:7] = b"\x01CD001\x01"
+    pvd[156:190] = directory_record("\x00", ROOT_LBA, SECTOR_SIZE, True)
+    put(16, pvd)
+    root = dot_records(ROOT_LBA, ROOT_LBA)
+    root += directory_record("MAP", MAP_DIR_LBA, SECTOR_SIZE, True)
+    put(ROOT_LBA, root)
+    map_dir = dot_records(MAP_DIR_LBA, ROOT_LBA)
+    for (name, (lba, size)) in layout.items():
+        map_dir += directory_record(name + ";1", lba, size, False)
+    put(MAP_DIR_LBA, map_dir)
+    for (name, data) in files.items():
+        put(layout[name][0], data)
+    return bytes(image)
+
+
+def raw_image(image, mode):
+    """Wrap every 2048-byte sector of `image` in a 2352-byte raw sector."""
+    sectors = []
+    for lba in range(len(image) // SECTOR_SIZE):
+        header = SYNC + bytes([0, 2, 0, mode])
+        if mode == 2:
+            header += b"\x00\x00\x08\x00" * 2
+        data = image[lba * SECTOR_SIZE : (lba + 1) * SECTOR_SIZE]
+        trailer = bytes(RAW_SECTOR_SIZE - len(header) - len(data))
+        sectors.append(header + data + trailer)
+    return b"".join(sectors)
+
+
+@pytest.fixture
+def files():
+    rng = random.Random(19)
+    return {
+        "MAP001.GNS": bytes(rng.randrange(256) for _ in range(300)),
+        "MAP001.8": bytes(rng.randrange(256) for _ in range(5000)),
+        "MAP001.9": bytes(rng.randrange(256) for _ in range(2048)),
+        "MAP001.11": b"",
+    }
+
+
+@pytest.fixture(params=["iso", "mode1", "mode2"])
+def disc(request, tmp_path, files):
+    image = iso_image(files)
+    if request.param == "iso":
+        path = tmp_path / "disc.iso"
+    else:
+        image = raw_image(image, 1 if request.param == "mode1" else 2)
+        path = tmp_path / "disc.bin"
+    path.write_bytes(image)
+    return DiscImage(str(path))
+
+
+def test_listdir(disc, files):
+    assert disc.listdir() == ["MAP"]
+    assert sorted(disc.listdir("MAP")) == sorted(files)
+
+
+def test_find(disc, files):
+    record = disc.find("map/map001.9")
+    assert (record.name, record.size, record.is_dir) == ("MAP001.9", 2048, False)
+    assert disc.find("MAP").is_dir
+    with pytest.raises(FileNotFoundError):
+        disc.find("MAP/MAP002.GNS")
+    with pytest.raises(FileNotFoundError):
+        disc.find("MAP/MAP001.9/X")
+
+
+def test_open_and_read(disc, files):
+    for (name, data) in files.items():
+        disc_file = disc.open("MAP/" + name)
+        assert disc_file.size == len(data)
+        assert bytes(disc_file.read()) == data
+
+
+def test_raw_reads_cross_sectors(tmp_path, files):
+    path = tmp_path / "disc.bin"
+    path.write_bytes(raw_image(iso_image(files), 2))
+    disc = DiscImage(str(path), cache_size=1)
+    assert disc.raw
+    data = files["MAP001.8"]
+    record = disc.find("MAP/MAP001.8")
+    assert bytes(disc.read(record.lba, len(data))) == data
+    assert len(disc.sectors) == 1
+
+
+def test_gns_read_disc(tmp_path, files):
+    (layout, _) = file_layout(files)
+    records = [
+        (0x22, 0, 0, RESOURCE_TEXTURE) + layout["MAP001.8"],
+        (0x22, 0, 0, RESOURCE_TYPE0) + layout["MAP001.9"],
+        (0, 0, 0, RESOURCE_EOF, 0, 0),
+    ]
+    gns_data = b"".join(RECORD.pack(*record) for record in records)
+    files = dict(files, **{"MAP001.GNS": gns_data.ljust(300, b"\x00")})
+    path = tmp_path / "disc.bin"
+    path.write_bytes(raw_image(iso_image(files), 2))
+    gns = GNS()
+    gns.read_disc(DiscImage(str(path)), "MAP/MAP001.GNS")
+    assert gns.situations == [(0x22, 0, 0, 0)]
+    (texture_file,) = gns.get_texture_files(0)
+    (resource_file,) = gns.get_resource_files(0)
+    assert bytes(texture_file.read()) == files["MAP001.8"]
+    assert bytes(resource_file.read()) == files["MAP001.9"]
+
+
+def test_not_a_disc(tmp_path):
+    path = tmp_path / "disc.iso"
+    path.write_bytes(bytes(SECTOR_SIZE * 17))
+    with pytest.raises(ValueError):
+        DiscImage(str(path))
+
+
+def test_open_disc_reuses_mapping(tmp_path, files):
+    path = tmp_path / "disc.iso"
+    path.write_bytes(iso_image(files))
+    disc = open_disc(str(path))
+    assert open_disc(str(path)) is disc
+    path.write_bytes(iso_image(dict(files, **{"MAP001.11": b"changed"})))
+    os.utime(path, ns=(0, disc.version[1] + 1))
+    reopened = open_disc(str(path))
+    assert reopened is not disc
+    assert bytes(reopened.open("MAP/MAP001.11").read()) == b"changed"
+
+
+def test_split_disc_path():
+    assert split_disc_path("FFT.BIN:MAP/MAP001.GNS") == ("FFT.BIN", "MAP/MAP001.GNS")
+    assert split_disc_path("C:/maps/MAP001.GNS") is None
+    assert split_disc_path("maps/MAP001.GNS") is None
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+from ganesha import fftmap
+from ganesha.resource import Resource, Resources
+from ganesha.writer import MapWriter, ResourceWriter, changed_runs
+from tests.util import random_bytes, write_resource_file
+
+CHUNKS = {
+    0x40: random_bytes(300, 1),
+    0x44: random_bytes(512, 2),
+    0x68: random_bytes(100, 3),
+    0x7C: random_bytes(512, 4),
+}
+
+
+def read_chunks(path):
+    resource = Resource()
+    resource.read(path)
+    return {
+        i * 4: bytes(resource.get_chunk(i)) for i in range(49) if resource.has_chunk(i)
+    }
+
+
+@pytest.fixture
+def path(tmp_path):
+    return write_resource_file(tmp_path / "MAP001.9", CHUNKS)
+
+
+def test_changed_runs():
+    old = bytes(100)
+    new = bytearray(old)
+    new[3] = new[10] = new[60] = 1
+    assert changed_runs(old, new) == [(3, 11), (60, 61)]
+    assert changed_runs(old, old) == []
+
+
+def test_patch_round_trip(path):
+    original = open(path, "rb").read()
+    inode = os.stat(path).st_ino
+    terrain = bytearray(CHUNKS[0x68])
+    terrain[5] ^= 0xFF
+    terrain[90] ^= 0xFF
+    writer = ResourceWriter(path)
+    writer.set_chunk(0x68, terrain)
+    writer.pack(0x44, 2, "<H", 0x1234)
+    assert writer.save() == 2 + 1 + 1
+    data = open(path, "rb").read()
+    assert len(data) == len(original)
+    assert sum(x != y for (x, y) in zip(data, original)) <= 4
+    expected = dict(CHUNKS)
+    expected[0x44] = CHUNKS[0x44][:2] + b"\x34\x12" + CHUNKS[0x44][4:]
+    expected[0x68] = bytes(terrain)
+    assert read_chunks(path) == expected
+    # Saved through a temporary file renamed over the original.
+    assert os.stat(path).st_ino != inode
+    assert os.listdir(os.path.dirname(path)) == ["MAP001.9"]
+
+
+def test_resize_round_trip(path):
+    terrain = random_bytes(160, 5)
+    writer = ResourceWriter(path)
+    writer.set_chunk(0x68, terrain)
+    size = os.path.getsize(path) + 60
+    assert writer.save() == size
+    assert os.path.getsize(path) == size
+    assert read_chunks(path) == {**CHUNKS, 0x68: terrain}
+    # The writer keeps working on the resized buffer.
+    writer.pack(0x7C, 0, "<B", 7)
+    assert writer.save() == 1
+    assert read_chunks(path)[0x7C] == b"\x07" + CHUNKS[0x7C][1:]
+
+
+def test_unchanged_save_writes_nothing(path):
+    writer = ResourceWriter(path)
+    writer.set_chunk(0x44, CHUNKS[0x44])
+    mtime = os.stat(path).st_mtime_ns
+    assert writer.save() == 0
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_pack_stays_inside_the_chunk(path):
+    writer = ResourceWriter(path)
+    with pytest.raises(ValueError):
+        writer.pack(0x68, -3, "<B", 7)
+    with pytest.raises(ValueError):
+        writer.pack(0x68, 99, "<H", 7)
+    writer.pack(0x68, 98, "<H", 7)
+
+
+def test_failed_save_keeps_the_original(path, monkeypatch):
+    original = open(path, "rb").read()
+    writer = ResourceWriter(path)
+    writer.set_chunk(0x68, random_bytes(160, 6))
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        writer.save()
+    assert open(path, "rb").read() == original
+    assert os.listdir(os.path.dirname(path)) == ["MAP001.9"]
+
+
+def test_map_writer_routes_chunks(tmp_path):
+    situation = write_resource_file(tmp_path / "MAP001.14", {0x68: bytes(100)})
+    base = write_resource_file(tmp_path / "MAP001.9", CHUNKS)
+    writer = MapWriter([situation, base])
+    writer.set_chunk(0x68, b"\x01" * 100)
+    writer.set_chunk(0x44, b"\x02" * 512)
+    with pytest.raises(KeyError):
+        writer.set_chunk(0x70, b"")
+    writer.save()
+    assert read_chunks(situation) == {0x68: b"\x01" * 100}
+    resources = Resources(pool=None)
+    resources.read([situation, base])
+    assert bytes(resources.get_chunk(0x44)) == b"\x02" * 512
+    assert bytes(resources.get_chunk(0x40)) == CHUNKS[0x40]
+
+
+def test_map_write_skips_missing_palettes(tmp_path):
+    path = write_resource_file(tmp_path / "MAP001.9", {0x68: CHUNKS[0x68]})
+    fft_map = fftmap.Map()
+    fft_map.resource_files = [path]
+    fft_map.resources.read(fft_map.resource_files)
+    palettes = fftmap.Palettes(bytes(512))
+    assert fft_map.write(color_palettes=palettes, gray_palettes=palettes) == 0
@@ -0,0 +1,22 @@
+import random
+from struct import pack
+
+TOC_SIZE = 0xC4
+
+
+def random_bytes(count, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for _ in range(count))
+
+
+def write_resource_file(path, chunks):
+    """Write a resource file holding `chunks` (TOC offset -> bytes), in TOC
+    order right after the TOC."""
+    toc = [0] * 49
+    body = b""
+    for toc_offset in sorted(chunks):
+        toc[toc_offset // 4] = TOC_SIZE + len(body)
+        body += chunks[toc_offset]
+    with open(path, "wb") as file:
+        file.write(pack("<49I", *toc) + body)
+    return str(path)